@@ -27,40 +27,100 @@ import atexit
 import contextlib
 import datetime
 import errno
+import fnmatch
+import functools
 import hashlib
+import heapq
+import json
+import mmap
 import os
+import queue
+import re
 import shutil
 import sqlite3
 import stat
 import sys
 import tempfile
+import threading
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from fnmatch import fnmatch
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from importlib.metadata import version, PackageNotFoundError
-from multiprocessing import freeze_support
+from multiprocessing import Value, freeze_support
 from os import stat_result
 from platform import node
+from typing import NamedTuple
+from urllib.request import pathname2url
 
 import unicodedata
 from progress.bar import IncrementalBar, Bar
+from progress.counter import Counter
 from send2trash import send2trash
 
+try:
+    import xxhash  # optional: pip install xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3  # optional: pip install blake3
+except ImportError:
+    blake3 = None
+try:
+    from watchdog.events import FileSystemEventHandler  # optional: pip install watchdog
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = Observer = None
+
 import folders
 from tools import human_format
 
 check_folders = (folders.misc_folder, folders.pics_folder, folders.music_folder)
 
 DEFAULT_CHUNK_SIZE = 16384  # block size in HFS+; 4X the block size in ext4
+MAX_CHUNK_SIZE = 1024 * 1024  # bigger reads don't go any faster, they just use more memory
+FINGERPRINT_SIZE = 1024 * 1024  # bytes read from each end of a file to make its fingerprint
+FINGERPRINT_THRESHOLD = 64 * 1024 * 1024  # smaller files are quick enough to hash in full
+MIN_BATCH_SIZE = 1024 * 1024  # bytes of files sent to a worker at once
+MAX_BATCH_SIZE = 1024 * 1024 * 1024
+HASH_MODES = ('auto', 'read', 'readinto', 'mmap')
+STREAM_BATCH_SIZE = 64 * 1024 * 1024  # bytes of streamed files to gather before sending them to a worker
+STREAM_WAIT = 1  # seconds to wait for more streamed paths before sending off a part-filled batch
+JOURNAL_HEARTBEAT = datetime.timedelta(minutes=1)  # how often watch_folders says it's still going
 DOT_THRESHOLD = 200
 IGNORED_FILE_SYSTEM_ERRORS = {errno.ENOENT, errno.EACCES}
 FSENCODING = sys.getfilesystemencoding()
+_rate_limit = None  # (shared next read time, bytes per second) in pool workers: see limit_rate
 FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS = 0x00400000
 try:
     VERSION = version("bitrot")
 except PackageNotFoundError:
     VERSION = "1.0.1"
 
+BITROT_COLUMNS = {
+    'path': 'TEXT PRIMARY KEY',
+    'mtime': 'INTEGER',
+    'hash': 'TEXT',
+    'timestamp': 'TEXT',
+    'size': 'INTEGER',
+    'inode': 'INTEGER',
+    'algorithm': 'TEXT',  # NULL means sha1, for rows stored before this column existed
+    'bucket': 'INTEGER',  # which integrity bucket the row belongs to: see path_bucket
+    'fingerprint': 'TEXT',  # quick check for renames of big files: see fingerprint_file
+    'sublist': 'INTEGER',  # which sublist the file gets checked in: see assign_sublists
+}
+INTEGRITY_BUCKETS = 256
+INTEGRITY_CHECK_DAYS = 32  # a normal check_sha512_integrity reads every bucket's rows once in this many days
+FULL_VACUUM_FRACTION = 0.25  # do a full vacuum when this fraction of the database is free pages
+HASH_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'blake2b': lambda: hashlib.blake2b(digest_size=16),  # 128 bits is plenty to spot bitrot
+}
+if xxhash:
+    HASH_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+if blake3:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+DEFAULT_ALGORITHM = 'sha1'
+
 
 def normalize_path(path):
     path_uni = path if isinstance(path, str) else path.decode(FSENCODING)
@@ -70,16 +130,132 @@ def normalize_path(path):
     return path_uni
 
 
-def sha1(path, chunk_size):
-    digest = hashlib.sha1()
+def pick_chunk_size(st, chunk_size=0):
+    """Return the size of reads to use for a file with the given stat result.
+    A non-zero `chunk_size` overrides the choice. Otherwise, use a multiple of the file system's
+    preferred block size, big enough to need only a few dozen reads for each file."""
+    if chunk_size:
+        return chunk_size
+    block_size = getattr(st, 'st_blksize', 0) or DEFAULT_CHUNK_SIZE  # no st_blksize on Windows
+    wanted = min(max(st.st_size // 32, block_size), MAX_CHUNK_SIZE)
+    return max(block_size, wanted // block_size * block_size)
+
+
+def limit_rate(next_read, bytes_per_second):
+    """Pool initializer: make reads in this process wait their turn so that all the workers together
+    read no more than `bytes_per_second`. `next_read` is a shared Value holding the time.monotonic()
+    at which the next read can start. Pass None for no limit."""
+    global _rate_limit
+    _rate_limit = None if next_read is None else (next_read, bytes_per_second)
+
+
+def throttle(size):
+    """Wait until the rate limit set by limit_rate allows another `size` bytes to be read."""
+    if _rate_limit is None:
+        return
+    next_read, bytes_per_second = _rate_limit
+    with next_read.get_lock():
+        now = time.monotonic()
+        start = max(next_read.value, now - 1)  # after a pause, allow a burst of up to a second's worth
+        next_read.value = start + size / bytes_per_second
+    if start > now:
+        time.sleep(start - now)
+
+
+def parse_window(text):
+    """Return (start, end) datetime.times from a time window like '22:00-07:00' (which wraps past midnight)."""
+    try:
+        start, end = (datetime.datetime.strptime(part.strip(), '%H:%M').time() for part in text.split('-'))
+    except ValueError as e:
+        raise BitrotException(2, f'Time window should look like 22:00-07:00, not {text}.') from e
+    return start, end
+
+
+def in_window(window, now=None):
+    """Return True if the time `now` (default: the current time) is inside the (start, end) window.
+    No window (None) means any time is fine."""
+    if window is None:
+        return True
+    start, end = window
+    now = (now or datetime.datetime.now()).time()
+    return start <= now < end if start <= end else now >= start or now < end
+
+
+def hash_file(path, chunk_size=0, algorithms=(DEFAULT_ALGORITHM,), mode='auto'):
+    """Return a list of hex digests of the file contents, one for each of the named algorithms.
+    The file is only read once however many algorithms are given.
+
+    `mode` is one of HASH_MODES: 'read' allocates a new bytes object for each chunk, 'readinto'
+    reuses a single buffer, and 'mmap' maps the file into memory so there's no copying at all.
+    'auto' is readinto: a read error or a file truncated while it's mapped kills the process with
+    SIGBUS rather than raising OSError, so mmap is only used when asked for. A `chunk_size` of 0
+    picks one to suit the file."""
+    digests = [HASH_ALGORITHMS[algorithm]() for algorithm in algorithms]
+    with open(path, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        chunk_size = pick_chunk_size(st, chunk_size)
+        if mode == 'auto':
+            mode = 'readinto'
+        if mode == 'mmap' and st.st_size:  # can't map an empty file
+            try:
+                hash_mapped_file(f, st.st_size, chunk_size, digests)
+                return [digest.hexdigest() for digest in digests]
+            except (OSError, ValueError):  # some network file systems can't do it
+                f.seek(0)
+                digests = [HASH_ALGORITHMS[algorithm]() for algorithm in algorithms]
+        if mode == 'read':
+            while d := f.read(chunk_size):
+                throttle(len(d))
+                for digest in digests:
+                    digest.update(d)
+        else:
+            buffer = bytearray(chunk_size)
+            with memoryview(buffer) as view:
+                while n := f.readinto(buffer):
+                    throttle(n)
+                    for digest in digests:
+                        digest.update(view[:n])
+    return [digest.hexdigest() for digest in digests]
+
+
+def hash_mapped_file(f, size, chunk_size, digests):
+    """Update each of the digests with the contents of the open file `f`, using a memory map."""
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        for offset in range(0, size, chunk_size):
+            chunk = view[offset:offset + chunk_size]
+            throttle(len(chunk))  # the page faults are where the reading happens
+            for digest in digests:
+                digest.update(chunk)
+            chunk.release()  # otherwise the map can't be closed
+
+
+def fingerprint_file(path, size):
+    """Return a quick fingerprint of a file made from its size and the first and last FINGERPRINT_SIZE bytes.
+    It can't spot bitrot in the middle, but it's plenty to tell if a new file is probably one that has moved."""
+    digest = hashlib.blake2b(size.to_bytes(8, 'little'), digest_size=16)
+    throttle(min(size, 2 * FINGERPRINT_SIZE))
     with open(path, 'rb') as f:
-        while d := f.read(chunk_size):
-            digest.update(d)
+        digest.update(f.read(FINGERPRINT_SIZE))
+        f.seek(max(size - FINGERPRINT_SIZE, 0))
+        digest.update(f.read(FINGERPRINT_SIZE))
     return digest.hexdigest()
 
 
-def ts():
-    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S%z')
+def stable_hash(path):
+    """Return a 64-bit hash of a Unicode path that's the same on every run and every computer
+    (unlike the built-in `hash`, which is randomised for each process)."""
+    digest = hashlib.blake2b(path.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def path_bucket(path):
+    """Return the integrity bucket that a Unicode path belongs to."""
+    return stable_hash(path) % INTEGRITY_BUCKETS
+
+
+def ts(ago=datetime.timedelta(0)):
+    """Return the time now (or `ago` before now) as a string, in UTC so they can be compared."""
+    return (datetime.datetime.now(datetime.timezone.utc) - ago).strftime('%Y-%m-%d %H:%M:%S%z')
 
 
 def get_sqlite3_cursor(path, copy=False):
@@ -97,85 +273,197 @@ def get_sqlite3_cursor(path, copy=False):
         atexit.register(os.unlink, path)
     conn = sqlite3.connect(path)
     atexit.register(conn.close)
+    conn.create_function('path_bucket', 1, path_bucket, deterministic=True)
     cur = conn.cursor()
     tables = {t for t, in cur.execute('SELECT name FROM sqlite_master')}
     if 'bitrot' not in tables:
-        cur.execute('CREATE TABLE bitrot (path TEXT PRIMARY KEY, '
-                    'mtime INTEGER, hash TEXT, timestamp TEXT)')
+        cur.execute('PRAGMA auto_vacuum=INCREMENTAL')  # has to be set before any tables are made
+        columns = ', '.join(f'{name} {col_type}' for name, col_type in BITROT_COLUMNS.items())
+        cur.execute(f'CREATE TABLE bitrot ({columns})')
+    else:
+        add_missing_columns(cur)
     if 'bitrot_hash_idx' not in tables:
         cur.execute('CREATE INDEX bitrot_hash_idx ON bitrot (hash)')
+    if 'bitrot_bucket_idx' not in tables:
+        cur.execute('CREATE INDEX bitrot_bucket_idx ON bitrot (bucket)')
+    if 'bitrot_integrity' not in tables:
+        cur.execute('CREATE TABLE bitrot_integrity (bucket INTEGER PRIMARY KEY, digest TEXT)')
+    if 'bitrot_checkpoint' not in tables:
+        # files to be hashed in the current run, so an interrupted run can carry on where it stopped
+        cur.execute('CREATE TABLE bitrot_checkpoint (path TEXT PRIMARY KEY, listed_path TEXT, '
+                    'sublist TEXT, verified TEXT)')
+    if 'bitrot_clashes' not in tables:
+        # hashes that differ from another node's database, from the last compare_nodes
+        cur.execute('CREATE TABLE bitrot_clashes (path TEXT, algorithm TEXT, node TEXT, hash TEXT, '
+                    'other_node TEXT, other_hash TEXT, checked TEXT)')
+    if 'bitrot_journal' not in tables:
+        # changes seen by watch_folders since the last run: event is changed, deleted, changed_dir or deleted_dir
+        cur.execute('CREATE TABLE bitrot_journal (path TEXT PRIMARY KEY, event TEXT, seen TEXT)')
+    if 'bitrot_meta' not in tables:
+        # journal_since, journal_heartbeat and last_full_walk timestamps
+        cur.execute('CREATE TABLE bitrot_meta (name TEXT PRIMARY KEY, value TEXT)')
+    cur.execute('UPDATE bitrot SET bucket=path_bucket(path) WHERE bucket IS NULL')
+    conn.commit()
     atexit.register(conn.commit)
     return conn
 
 
-def list_existing_paths(directory, ignored=(),
-                              verbosity=1, follow_links=False):
-    """list_existing_paths('/dir') -> ([path1, path2, ...], total_size)
+def tune_connection(conn):
+    """Set up a connection for lots of writes: use write-ahead logging, and don't wait for every
+    write to reach the disk. The database can lose the last few writes in a power cut, but
+    can't be corrupted, and those files just get hashed again next time."""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-65536')  # 64 MiB
+
+
+def compact_database(conn, verbosity=1):
+    """Give free pages back to the file system without rewriting the whole database.
+    Only do a full vacuum (which also defragments it) if a lot of it is free space."""
+    cur = conn.cursor()
+    if cur.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:  # 2 means incremental
+        # made by an older version: switching mode needs one last full vacuum
+        cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cur.execute('VACUUM')
+        return
+    free_pages = cur.execute('PRAGMA freelist_count').fetchone()[0]
+    all_pages = cur.execute('PRAGMA page_count').fetchone()[0]
+    if free_pages > all_pages * FULL_VACUUM_FRACTION:
+        if verbosity > 1:
+            print(f'{free_pages} of {all_pages} pages free: full vacuum')
+        cur.execute('VACUUM')
+    elif free_pages:
+        cur.execute('PRAGMA incremental_vacuum').fetchall()  # frees one page per step, so step to the end
+
+
+def add_missing_columns(cur):
+    """Bring a database made by an older version up to date by adding any new columns.
+    Existing rows get NULL in the new columns, which means 'not known yet'."""
+    existing = {row[1] for row in cur.execute('PRAGMA table_info(bitrot)')}
+    for name, col_type in BITROT_COLUMNS.items():
+        if name not in existing:
+            cur.execute(f'ALTER TABLE bitrot ADD COLUMN {name} {col_type}')
+
+
+def compile_wildcards(wildcards):
+    """Combine a list of wildcards like '*.tmp' into one regular expression, to match against a single
+    path component. Matching ignores case where the file system does, like fnmatch."""
+    if not wildcards:
+        return None
+    flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+    return re.compile('|'.join(fnmatch.translate(wildcard) for wildcard in wildcards), flags)
+
+
+def scan_folder(folder, follow_links=False):
+    """Return a list of (DirEntry, stat) for the files in a folder, and a list of DirEntry for its subfolders.
+    The stats are gathered here (in a worker thread). DirEntry.stat is free on Windows, but always gives
+    st_ino and st_dev as 0 there, so those files get a proper os.stat.
+    Files and folders that can't be read are skipped (with a warning, unless they've just gone), like os.walk does."""
+    files, subfolders = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):  # never follow links to folders, like os.walk
+                        subfolders.append(entry)
+                        continue
+                    st = entry.stat(follow_symlinks=follow_links)
+                    if not st.st_ino:
+                        st = os.stat(entry.path, follow_symlinks=follow_links)
+                    files.append((entry, st))
+                except OSError as ex:  # disappeared or locked since listing
+                    if ex.errno not in IGNORED_FILE_SYSTEM_ERRORS:
+                        print(f'\rwarning: cannot read {os.fsdecode(entry.path)}: {ex}', file=sys.stderr)
+    except OSError as ex:  # can't read this folder: skip it
+        if ex.errno not in IGNORED_FILE_SYSTEM_ERRORS and ex.errno != errno.ENOTDIR:
+            print(f'\rwarning: cannot list {os.fsdecode(folder)}: {ex}', file=sys.stderr)
+    return files, subfolders
 
-    Returns a tuple with a set of existing files in `directory` and its subdirectories
-    and their `total_size`. If directory was a bytes object, so will be the returned
-    paths.
 
-    Doesn't add entries listed in `ignored`.  Doesn't add symlinks or cloud-only files if
-    `follow_links` is False (the default).  All entries present in `expected`
-    must be files (can't be directories or symlinks).
+def list_existing_paths(directory, ignored=(),
+                        verbosity=1, follow_links=False, threads=16):
+    """list_existing_paths('/dir') -> ({path1: stat1, path2: stat2, ...}, total_size)
+
+    Returns a tuple with a dict of existing files in `directory` and its subdirectories
+    and their `total_size`. The values of the dict are the `os.stat` results gathered
+    while listing, so they can be reused later without another call to `os.stat`.
+    If directory was a bytes object, so will be the returned paths.
+
+    Doesn't add entries listed in `ignored`: these are wildcards matched against each path
+    component, so 'dir*', '*2', '*.txt', etc. exclude anything, and excluded folders aren't
+    listed at all. Doesn't add symlinks or cloud-only files if `follow_links` is False (the default).
+    Folders are scanned by a pool of `threads` at once, which helps a lot on network drives.
     """
-    paths = set()
+    paths = {}
     total_size = 0
-    path_list = []
-    for path, _, files in os.walk(directory):
-        for f in files:
-            p = os.path.join(path, f)
-            try:
-                p_uni = p if isinstance(p, str) else p.decode(FSENCODING)
-            except UnicodeDecodeError:
-                binary_stderr = getattr(sys.stderr, 'buffer', sys.stderr)
-                binary_stderr.write("warning: cannot decode file name: ")
-                binary_stderr.write(p)
-                binary_stderr.write("\n")
-                continue
-            path_list.append(p)
-    with IncrementalBar('Listing files', max=len(path_list), suffix='%(index)d/%(max)d') as bar:
-        stat_list = [get_stat(p, bar if verbosity else None, follow_links) for p in path_list]
-    for p, st in zip(path_list, stat_list):
-        # split path /dir1/dir2/file.txt into
-        # ['dir1', 'dir2', 'file.txt']
-        # and match on any of these components
-        # so we could use 'dir*', '*2', '*.txt', etc. to exclude anything
-        exclude_this = [fnmatch(ff, wildcard) for ff in p.split(os.path.sep) for wildcard in ignored]
-        ignore_reason = 'in exclude list' if any(exclude_this) else ''
-
-        # check attributes - is it a cloud-only file? (e.g. from OneDrive)
-        # https://learn.microsoft.com/en-us/windows/win32/fileio/file-attribute-constants
-        if not follow_links and getattr(st, 'st_file_attributes', 0) & FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS:
-            ignore_reason = ignore_reason or 'cloud-only'
-
-        if not stat.S_ISREG(st.st_mode):
-            ignore_reason = ignore_reason or 'not regular file'
-        if ignore_reason:
-            if verbosity > 1:
-                print(f'Ignoring file ({ignore_reason}):', p)
-            continue
-        paths.add(p)
-        total_size += st.st_size
+    excluded = compile_wildcards(ignored)
+
+    def is_excluded(entry):
+        return excluded is not None and excluded.match(os.fsdecode(entry.name))
+
+    with (Counter('Listing files ') if verbosity else contextlib.nullcontext()) as counter, \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        running = {executor.submit(scan_folder, directory, follow_links)}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                for entry in subfolders:
+                    if is_excluded(entry):
+                        if verbosity > 1:
+                            print('Ignoring folder (in exclude list):', entry.path)
+                        continue
+                    running.add(executor.submit(scan_folder, entry.path, follow_links))
+                for entry, st in files:
+                    p = entry.path
+                    try:
+                        p_uni = p if isinstance(p, str) else p.decode(FSENCODING)
+                    except UnicodeDecodeError:
+                        binary_stderr = getattr(sys.stderr, 'buffer', sys.stderr)
+                        binary_stderr.write(b"warning: cannot decode file name: ")
+                        binary_stderr.write(p)
+                        binary_stderr.write(b"\n")
+                        continue
+                    ignore_reason = 'in exclude list' if is_excluded(entry) else ''
+
+                    # check attributes - is it a cloud-only file? (e.g. from OneDrive)
+                    # https://learn.microsoft.com/en-us/windows/win32/fileio/file-attribute-constants
+                    if not follow_links and getattr(st, 'st_file_attributes', 0) & FILE_ATTRIBUTE_RECALL_ON_DATA_ACCESS:
+                        ignore_reason = ignore_reason or 'cloud-only'
+
+                    if not stat.S_ISREG(st.st_mode):
+                        ignore_reason = ignore_reason or 'not regular file'
+                    if ignore_reason:
+                        if verbosity > 1:
+                            print(f'Ignoring file ({ignore_reason}):', p_uni)
+                        continue
+                    paths[p] = st
+                    total_size += st.st_size
+                    if verbosity:
+                        counter.next()
     return paths, total_size
 
 
-def get_stat(p: str, bar: Bar | None = None, follow_links: bool = False) -> stat_result:
+def get_stat(p: str, bar: Bar | None = None, follow_links: bool = False) -> stat_result | None:
     if bar:
         bar.next()
     try:
-        st = os.stat(p, follow_symlinks=follow_links)
+        return os.stat(p, follow_symlinks=follow_links)
     except OSError as ex:
         if ex.errno not in IGNORED_FILE_SYSTEM_ERRORS:
             raise
-    return st
+    return None
 
 
 class BitrotException(Exception):
     pass
 
 
+class WindowClosed(Exception):
+    """Raised when a run goes past the end of its time window. The checkpoint lets the next run carry on."""
+
+
 def list_paths(paths, list_type):
     print(f'{len(paths)} entries {list_type}:')
     paths.sort()
@@ -190,11 +478,38 @@ def get_terminal_width():
     return terminal_size.columns
 
 
-def compute_one(path, chunk_size, sublist_count, sublist_index):
-    """Return a tuple with (unicode path, size, mtime, sha1). Takes a binary path."""
+class FileResult(NamedTuple):
+    """What compute_one found out about a file."""
+    path: str
+    """The Unicode path, normalized if FSENCODING was UTF-8."""
+    size: int
+    """The size of the file in bytes."""
+    mtime: int
+    """The modification time of the file, truncated to whole seconds."""
+    inode: int
+    """The inode number (or file index on Windows) of the file."""
+    hash: str
+    """The hash of the file contents."""
+    algorithm: str
+    """The name of the algorithm used to compute `hash`."""
+    verify_hash: str | None = None
+    """The hash computed with the algorithm stored in the database, if that was different."""
+    fingerprint: str | None = None
+    """The fingerprint of a big file, from fingerprint_file."""
+
+
+def compute_one(path, chunk_size, st=None, algorithm=DEFAULT_ALGORITHM, verify_algorithm=None, hash_mode='auto',
+                fingerprints=None):
+    """Return a FileResult for the given path.
+
+    Pass `st` to reuse a stat result from the listing rather than calling `os.stat` again.
+    Pass `verify_algorithm` to compute a second hash in the same pass, so that a hash stored
+    with an older algorithm can be checked before being replaced.
+    Pass a set of `fingerprints` of files that have gone missing: if the file matches one of them,
+    it isn't hashed at all, and the result has a hash of None."""
     p_uni = normalize_path(path)
     try:
-        st = os.stat(path)
+        st = st or os.stat(path)
     except OSError as ex:
         if ex.errno in IGNORED_FILE_SYSTEM_ERRORS:
             # The file disappeared between listing existing paths and
@@ -208,11 +523,13 @@ def compute_one(path, chunk_size, sublist_count, sublist_index):
 
         raise  # Not expected? https://github.com/ambv/bitrot/issues/
 
-    if sublist_count > 1 and sublist_index != hash(path) % sublist_count:
-        return p_uni, st.st_size, int(st.st_mtime), None
-
+    algorithms = (algorithm, verify_algorithm) if verify_algorithm not in (None, algorithm) else (algorithm,)
     try:
-        new_sha1 = sha1(path, chunk_size)
+        fingerprint = fingerprint_file(path, st.st_size) if st.st_size >= FINGERPRINT_THRESHOLD else None
+        if fingerprints and fingerprint in fingerprints:
+            # probably moved: leave the full check until its sublist comes up
+            return FileResult(p_uni, st.st_size, int(st.st_mtime), st.st_ino, None, algorithm, None, fingerprint)
+        new_hash, *verify_hash = hash_file(path, chunk_size, algorithms, hash_mode)
     except (IOError, OSError) as e:
         print(
             f'\rwarning: cannot compute hash of {p_uni} [{errno.errorcode[e.args[0]]}]',
@@ -220,14 +537,210 @@ def compute_one(path, chunk_size, sublist_count, sublist_index):
         )
         raise BitrotException from e
 
-    return p_uni, st.st_size, int(st.st_mtime), new_sha1
+    return FileResult(p_uni, st.st_size, int(st.st_mtime), st.st_ino, new_hash, algorithm,
+                      verify_hash[0] if verify_hash else None, fingerprint)
+
+
+class StoredRow(NamedTuple):
+    """A row of the bitrot table, as read at the start of a run."""
+    mtime: int
+    hash: str
+    timestamp: str
+    size: int | None
+    inode: int | None
+    algorithm: str
+    fingerprint: str | None
+
+
+class WorkItem(NamedTuple):
+    """A file to be hashed by one of the pool workers."""
+    path: bytes | str
+    """The path as listed."""
+    st: stat_result | None
+    """The stat result from the listing, if there is one."""
+    verify_algorithm: str | None
+    """The algorithm of a hash stored in the database that needs checking too."""
+    fingerprints: frozenset | None = None
+    """Fingerprints of missing files of the same size, if this might be one of them that has moved."""
+
+
+def compute_batch(batch, chunk_size, algorithm=DEFAULT_ALGORITHM, hash_mode='auto'):
+    """Run compute_one for each WorkItem in the batch, and return a list of FileResults.
+    Files that can't be read are left out (compute_one has already printed a warning)."""
+    results = []
+    for item in batch:
+        with contextlib.suppress(BitrotException):
+            results.append(compute_one(item.path, chunk_size, item.st, algorithm, item.verify_algorithm, hash_mode,
+                                       item.fingerprints))
+    return results
+
+
+def make_batches(items, target_size, max_count=1000):
+    """Split a list of WorkItems into batches holding roughly `target_size` bytes each,
+    and never more than `max_count` files. Bigger files end up in a batch of their own."""
+    batch = []
+    batch_size = 0
+    for item in items:
+        batch.append(item)
+        batch_size += item.st.st_size if item.st else 0
+        if batch_size >= target_size or len(batch) >= max_count:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def assign_sublists(sizes, loads):
+    """Give each of the files in `sizes` (a dict where keys are Unicode paths and values are sizes in bytes)
+    to the sublist with the fewest bytes in it so far, biggest files first so the sublists come out even.
+    `loads` is a list of the bytes already in each sublist, and is updated as files are added.
+    Return a dict where keys are paths and values are sublist indices.
+
+    The sublists are stored in the database, and a file stays in the same one from then on (even if it's
+    renamed), so adding and removing files never moves the others: each one is checked every
+    `len(loads)` days, however the folder changes."""
+    heap = [(load, i) for i, load in enumerate(loads)]
+    heapq.heapify(heap)
+    sublists = {}
+    for path in sorted(sizes, key=lambda p: (-sizes[p], p)):
+        load, i = heapq.heappop(heap)
+        sublists[path] = i
+        loads[i] += sizes[path]
+        heapq.heappush(heap, (loads[i], i))
+    return sublists
+
+
+@functools.cache
+def is_rotational(device):
+    """Return True if the block device with the given `st_dev` number is a spinning disk,
+    False if it's an SSD, or None if we can't tell (e.g. not on Linux, or a network share)."""
+    sys_path = f'/sys/dev/block/{os.major(device)}:{os.minor(device)}' if hasattr(os, 'major') else ''
+    if not sys_path or not os.path.exists(sys_path):
+        return None
+    sys_path = os.path.realpath(sys_path)
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        sys_path = os.path.dirname(sys_path)  # the queue settings belong to the whole disk
+    try:
+        with open(os.path.join(sys_path, 'queue', 'rotational')) as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return None
+
+
+def stat_unchanged(st, stored):
+    """Return True if the stat result `st` matches the stored (mtime, size, inode) of a file.
+    Size and inode may be NULL in the database if it was made by an older version, and an inode of 0
+    (stored from a DirEntry.stat on Windows by an older version) isn't known either."""
+    stored_mtime, stored_size, stored_inode = stored
+    return (int(st.st_mtime) == stored_mtime
+            and stored_size in (None, st.st_size)
+            and stored_inode in (None, 0, st.st_ino))
+
+
+def device_name(device):
+    """Return a readable name for an `st_dev` number, like 8:1 on Linux."""
+    return f'{os.major(device)}:{os.minor(device)}' if hasattr(os, 'major') else str(device)
+
+
+class Metrics(object):
+    """Timings and throughput for one run of Bitrot, so slow folders and disks can be spotted.
+    See write_metrics for saving them."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = {}  # stage: time spent on it in seconds
+        self.devices = {}  # st_dev: dict of files, bytes and seconds spent reading it
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Add the time spent inside the with block to the total for a stage (e.g. 'listing')."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = self.seconds.get(stage, 0) + time.perf_counter() - start
+
+    def device_started(self, device):
+        """Note that the first batch from a device has been sent to the pool."""
+        self.devices.setdefault(device, {'files': 0, 'bytes': 0, 'start': time.perf_counter(), 'seconds': 0})
+
+    def device_done(self, device, results):
+        """Add a batch of FileResults from a device to its total."""
+        stats = self.devices[device]
+        stats['files'] += len(results)
+        stats['bytes'] += sum(result.size for result in results if result.hash is not None)
+        stats['seconds'] = time.perf_counter() - stats['start']
+
+    def as_dict(self, **counts):
+        """Return the metrics as a dict suitable for JSON, with the given counts added."""
+        hashing_time = self.seconds.get('hashing', 0)
+        return {
+            'timestamp': datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+            **counts,
+            'files_per_second': round(counts.get('files_hashed', 0) / hashing_time, 1) if hashing_time else 0,
+            'bytes_per_second': round(counts.get('bytes_hashed', 0) / hashing_time) if hashing_time else 0,
+            **{f'{stage}_seconds': round(seconds, 3) for stage, seconds in self.seconds.items()},
+            'total_seconds': round(time.time() - self.started, 3),
+            'devices': {device_name(device): {
+                'files': stats['files'],
+                'bytes': stats['bytes'],
+                'seconds': round(stats['seconds'], 3),
+                'bytes_per_second': round(stats['bytes'] / stats['seconds']) if stats['seconds'] else 0,
+                'rotational': is_rotational(device),
+            } for device, stats in self.devices.items()},
+        }
+
+
+def write_metrics(path, metrics):
+    """Save a dict of metrics from Metrics.as_dict. If `path` ends in .prom, write a textfile for
+    the node exporter's textfile collector, replacing the lines from the last run in the same folder.
+    Otherwise, append a line of JSON to it."""
+    if not path.endswith('.prom'):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(metrics) + '\n')
+        return
+
+    def label_text(labels):
+        escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"') for name, value in labels.items()}
+        return ','.join(f'{name}="{value}"' for name, value in escaped.items())
+
+    labels = {'node': metrics['node'], 'folder': metrics['folder']}
+    this_folder = label_text(labels)
+    lines = []
+    for name, value in metrics.items():
+        if isinstance(value, (int, float)):  # bools too
+            lines.append(f'bitrot_{name}{{{this_folder}}} {float(value)}')
+    for device, stats in metrics['devices'].items():
+        device_labels = label_text({**labels, 'device': device})
+        lines += [f'bitrot_device_{name}{{{device_labels}}} {float(value)}' for name, value in stats.items()
+                  if value is not None]  # e.g. rotational, when it couldn't be told
+    try:
+        with open(path, encoding='utf-8') as f:
+            # keep the other folders' metrics
+            lines = [line.rstrip('\n') for line in f if this_folder not in line] + lines
+    except FileNotFoundError:
+        pass
+    # the collector might read it at any moment, so swap in a complete file
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+class FileCounter(Counter):
+    """Progress for when the total isn't known: counts files, whatever size they are."""
+
+    def next(self, n=1):
+        super().next()
 
 
 class Bitrot(object):
     def __init__(self, verbosity=1, test=False, follow_links=False, commit_interval=300,
-                 chunk_size=DEFAULT_CHUNK_SIZE, file_list=None, exclude_list=None,
+                 chunk_size=0, file_list=None, exclude_list=None,
                  workers=max(os.cpu_count() - 1, 1),
-                 sublist_count=30, sublist_index=None):
+                 sublist_count=30, sublist_index=None, quick=False, algorithm=DEFAULT_ALGORITHM,
+                 hash_mode='auto', device_workers=0, provisional_renames=True, metrics_file=None,
+                 journal=False, full_walk_days=7, max_rate=0, window=None):
         if exclude_list is None:
             exclude_list = []
         self.verbosity = verbosity
@@ -239,22 +752,253 @@ class Bitrot(object):
         self.exclude_list = exclude_list
         self._last_reported_size = ''
         self._last_commit_ts = 0
-        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self._pending_writes = {}  # SQL statement: list of parameter tuples
+        self._dirty_buckets = set()  # integrity buckets with rows that have changed
+        self._sublists = {}  # Unicode path: sublist index
+        self._sublist_loads = []  # bytes in each sublist, for giving new files one: see load_sublists
+        self._resumed = set()  # Unicode paths left to hash by an interrupted run: checked whatever their sublist
+        self._missing_fingerprints = {}  # (size, fingerprint): list of missing Unicode paths
+        self._fingerprinted = {}  # Unicode path: WorkItem sent to be fingerprinted rather than hashed
+        self._rehash = deque()  # WorkItems for hash_in_pool to hash in full after all: see process_results
+        self.hashed_size = 0
+        self.hashed_count = 0
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        self.journal = journal
+        self.full_walk_days = full_walk_days
+        self._unchecked_size = 0  # bytes of files we know are there but didn't look at (see list_from_journal)
+        self.workers = workers
+        self.max_rate = max_rate  # MB/s for all the workers together; 0 for no limit
+        rate_limit = (Value('d', 0.0), max_rate * 1e6) if max_rate else (None, 0)
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=limit_rate, initargs=rate_limit)
+        self.window = parse_window(window) if window else None  # only read files between these times
         self.sublist_count = sublist_count
         if sublist_index is None:
             sublist_index = datetime.datetime.today().toordinal() % self.sublist_count
         self.sublist_index = sublist_index
+        self.quick = quick
+        if algorithm not in HASH_ALGORITHMS:
+            raise BitrotException(2, f'Hash algorithm {algorithm} is not available.')
+        self.algorithm = algorithm
+        self.hash_mode = hash_mode
+        self.device_workers = device_workers
+        self.provisional_renames = provisional_renames
+
+    def load_sublists(self, conn, rows):
+        """Read the sublist each file is in from the database. Rows stored by an older version get one now,
+        and so do all of them if `sublist_count` has changed since they were given out."""
+        if self.sublist_count <= 1:
+            return  # new rows get a sublist when there's more than one
+        cur = conn.cursor()
+        stored_count = cur.execute("SELECT value FROM bitrot_meta WHERE name='sublist_count'").fetchone()
+        if stored_count == (str(self.sublist_count),):
+            self._sublists = {path: sublist for path, sublist in cur.execute('SELECT path, sublist FROM bitrot')
+                              if sublist is not None and sublist < self.sublist_count}
+        self._sublist_loads = [0] * self.sublist_count
+        for path, sublist in self._sublists.items():
+            self._sublist_loads[sublist] += rows[path].size or 0
+        unassigned = {path: row.size or 0 for path, row in rows.items() if path not in self._sublists}
+        if unassigned or not stored_count:
+            new_sublists = assign_sublists(unassigned, self._sublist_loads)
+            self._sublists.update(new_sublists)
+            with conn:  # doesn't change any integrity buckets: the sublist isn't part of their digests
+                conn.executemany('UPDATE bitrot SET sublist=? WHERE path=?',
+                                 [(sublist, path) for path, sublist in new_sublists.items()])
+                conn.execute("INSERT OR REPLACE INTO bitrot_meta VALUES ('sublist_count', ?)",
+                             (str(self.sublist_count),))
+
+    def new_sublist(self, path, size):
+        """Return the sublist for a new row (the one with the fewest bytes), or None if there aren't sublists."""
+        if not self._sublist_loads:
+            return None
+        self._sublists.update(assign_sublists({path: size}, self._sublist_loads))
+        return self._sublists[path]
+
+    def in_sublist(self, path):
+        """Return True if the given Unicode path is in the sublist being checked in this run."""
+        return self.sublist_count <= 1 or self._sublists.get(path) == self.sublist_index or path in self._resumed
+
+    def readers_for_device(self, device):
+        """Return the number of workers allowed to read from the given device at the same time.
+        If it wasn't set when creating Bitrot, use one for spinning disks and all of them otherwise."""
+        if self.device_workers:
+            return min(self.device_workers, self.workers)
+        return 1 if is_rotational(device) else self.workers
+
+    def hash_in_pool(self, work, target_size):
+        """Hash the WorkItems in `work` using the pool, and yield lists of FileResults as batches complete.
+
+        Files are grouped by device, and each device only has as many batches in progress at once
+        as readers_for_device allows, so one disk doesn't get thrashed by all the workers.
+        Within a device, files are read in inode order, which roughly follows their position on disk.
+        WorkItems put in `_rehash` while this is going are sent off too."""
+        by_device = {}
+        for item in sorted(work, key=lambda item: (item.st.st_dev, item.st.st_ino)):
+            by_device.setdefault(item.st.st_dev, []).append(item)
+        queues = {device: deque(make_batches(items, target_size)) for device, items in by_device.items()}
+        limits = {device: self.readers_for_device(device) for device in queues}
+        if self.verbosity > 1:
+            for device, limit in limits.items():
+                print(f'Device {device}: {len(by_device[device])} files, {limit} readers')
+        running = {}  # future: device
+        window_closed = False
+        while queues or running or self._rehash:
+            while self._rehash:
+                item = self._rehash.popleft()
+                queues.setdefault(item.st.st_dev, deque()).append([item])
+                if item.st.st_dev not in limits:
+                    limits[item.st.st_dev] = self.readers_for_device(item.st.st_dev)
+            if queues and not in_window(self.window):
+                # finish off the batches in progress, and leave the rest for the next run
+                queues.clear()
+                window_closed = True
+            # keep every device busy up to its limit
+            for device, queue in list(queues.items()):
+                in_progress = sum(1 for running_device in running.values() if running_device == device)
+                while queue and in_progress < limits[device]:
+                    self.metrics.device_started(device)
+                    future = self.pool.submit(compute_batch, queue.popleft(), self.chunk_size,
+                                              self.algorithm, self.hash_mode)
+                    running[future] = device
+                    in_progress += 1
+                if not queue:
+                    del queues[device]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                self.metrics.device_done(running.pop(future), results)
+                yield results
+        if window_closed:
+            raise WindowClosed
+
+    def hash_stream(self, lines, verify_algorithm_for):
+        """Hash the files named in `lines` (e.g. a file list piped into stdin) as the names come in,
+        and yield lists of FileResults as batches complete. `verify_algorithm_for` is a function that
+        returns the verify_algorithm for a WorkItem, given its Unicode path.
+
+        Only the batches being filled and the ones in the pool are held in memory, however long the list
+        is. Each device gets its own batches, which are sent off when they hold STREAM_BATCH_SIZE bytes,
+        or when no more names have come in for STREAM_WAIT seconds. Reading the list waits while a
+        device already has as many batches in progress as readers_for_device allows."""
+        incoming = queue.Queue(maxsize=1000)
+        if lines is sys.stdin:
+            # Workers close sys.stdin as they start, which never finishes if they were forked while
+            # read_lines was holding its lock. So read the same file descriptor through another object.
+            lines = open(sys.stdin.fileno(), closefd=False, encoding=sys.stdin.encoding, errors=sys.stdin.errors)
+
+        def read_lines():
+            for line in lines:
+                incoming.put(line)
+            incoming.put(None)  # that's all
+
+        threading.Thread(target=read_lines, daemon=True).start()
+        batches = {}  # device: list of WorkItems
+        batch_sizes = {}  # device: bytes
+        running = {}  # future: device
+        line = ''
+        window_closed = False
+        while line is not None:
+            if not in_window(self.window):
+                window_closed = True  # the rest of the list doesn't get read
+                break
+            try:
+                line = incoming.get(timeout=STREAM_WAIT)
+            except queue.Empty:
+                line = ''  # nothing new for a while
+            ready = list(batches) if not line else []  # send off everything we have at the end or in a lull
+            if line:
+                p = line.rstrip('\n').encode(FSENCODING)
+                if not os.path.isabs(p):
+                    p = os.path.join(b'.', os.path.normpath(p))  # as they are in a listing, so the rows match
+                st = get_stat(p, follow_links=self.follow_links)
+                if st is None or not stat.S_ISREG(st.st_mode):
+                    continue
+                batches.setdefault(st.st_dev, []).append(WorkItem(p, st, verify_algorithm_for(normalize_path(p))))
+                batch_sizes[st.st_dev] = batch_sizes.get(st.st_dev, 0) + st.st_size
+                if batch_sizes[st.st_dev] >= STREAM_BATCH_SIZE or len(batches[st.st_dev]) >= 1000:
+                    ready = [st.st_dev]
+            for device in ready:
+                limit = self.readers_for_device(device)
+                while sum(1 for running_device in running.values() if running_device == device) >= limit:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results = future.result()
+                        self.metrics.device_done(running.pop(future), results)
+                        yield results
+                self.metrics.device_started(device)
+                future = self.pool.submit(compute_batch, batches.pop(device), self.chunk_size,
+                                          self.algorithm, self.hash_mode)
+                running[future] = device
+                del batch_sizes[device]
+            for future in [future for future in running if future.done()]:
+                results = future.result()
+                self.metrics.device_done(running.pop(future), results)
+                yield results
+        for future in as_completed(list(running)):
+            results = future.result()
+            self.metrics.device_done(running.pop(future), results)
+            yield results
+        if window_closed:
+            raise WindowClosed
+
+    def queue_write(self, sql, params, *paths):
+        """Store up a write to the database, to be done along with others like it in flush_writes.
+        `paths` are the paths of the rows affected, so their integrity buckets can be updated."""
+        self._pending_writes.setdefault(sql, []).append(params)
+        self._dirty_buckets.update(path_bucket(path) for path in paths)
+
+    def flush_writes(self, conn):
+        """Do all the stored-up writes in one transaction, using executemany for each kind of statement.
+        The digests of the integrity buckets they touch are updated in the same transaction, so the stored
+        digests always match the rows, however the run ends."""
+        with self.metrics.timer('committing'), conn:  # commits at the end
+            for sql, param_list in self._pending_writes.items():
+                conn.executemany(sql, param_list)
+            cur = conn.cursor()
+            conn.executemany('INSERT OR REPLACE INTO bitrot_integrity VALUES (?, ?)',
+                             [(bucket, bucket_digest(cur, bucket)) for bucket in self._dirty_buckets])
+        self._pending_writes = {}
+        self._dirty_buckets = set()
+
+    def unfinished_checkpoint(self, cur):
+        """Look for files left to hash by an interrupted run, and return a list of their paths
+        (as they were listed, so they can be opened again). They get checked along with today's sublist,
+        so an interruption doesn't mean today's sublist is never done."""
+        cur.execute('SELECT listed_path, sublist FROM bitrot_checkpoint WHERE verified IS NULL')
+        left = cur.fetchall()
+        if left:
+            self._resumed = {normalize_path(path) for path, _ in left}
+            if self.verbosity:
+                print(f'Carrying on with {len(left)} files left from sublist {left[0][1].replace("/", " of ")}')
+        return [path for path, _ in left]
+
+    def save_checkpoint(self, conn, work):
+        """Record the list of WorkItems to be hashed in this run, replacing any earlier one."""
+        sublist = f'{self.sublist_index}/{self.sublist_count}'
+        with conn:
+            conn.execute('DELETE FROM bitrot_checkpoint')
+            conn.executemany('INSERT OR REPLACE INTO bitrot_checkpoint VALUES (?, ?, ?, NULL)',
+                             [(normalize_path(item.path), os.fsdecode(item.path), sublist) for item in work])
 
     def maybe_commit(self, conn):
         if time.time() < self._last_commit_ts + self.commit_interval:
             # no time for commit yet!
             return
 
-        conn.commit()
+        self.flush_writes(conn)
         self._last_commit_ts = time.time()
 
     def run(self):
-        # check_sha512_integrity(verbosity=self.verbosity)
+        # check_sha512_integrity(verbosity=self.verbosity, part=(self.sublist_index, self.sublist_count))
+
+        if not in_window(self.window):
+            if self.verbosity:
+                start, end = self.window
+                print(f'Not checking anything outside the time window {start:%H:%M}-{end:%H:%M}')
+            self.pool.shutdown()
+            return
 
         bitrot_db = get_path()
         bitrot_sha512 = get_path(ext='sha512')
@@ -263,51 +1007,285 @@ class Bitrot(object):
         except ValueError as e:
             raise BitrotException(2, 'No database exists so cannot test. Run the tool once first.') from e
 
+        if not self.test:
+            tune_connection(conn)
         cur = conn.cursor()
         new_paths = []
         updated_paths = []
         renamed_paths = []
         errors = []
-        current_size = 0
-        missing_paths = self.select_all_paths(cur)
-        hashes = self.select_all_hashes(cur)
-        if self.file_list:
-            paths = [line.rstrip('\n').encode(FSENCODING)
-                     for line in self.file_list.readlines()]
-            total_size = sum(os.path.getsize(filename) for filename in paths)
+        with self.metrics.timer('reading_database'):
+            rows, hashes = self.select_all(cur)
+            self.load_sublists(conn, rows)
+        missing_paths = set(rows)
+        resumed = [] if self.test else self.unfinished_checkpoint(cur)
+        # A file list is read as it comes in, and every file in it is checked, whatever today's sublist
+        streaming = self.file_list is not None and not resumed
+        # With a file list, just finish off the files that were left last time, and read the list next time
+        leftovers_only = self.file_list is not None and bool(resumed)
+        if streaming:
+            self.sublist_count = 1
+        ignored = [os.path.basename(bitrot_db) + '*',  # including -wal and -shm files
+                   '.bitrot-*.db-*',  # other nodes' -wal and -shm files
+                   os.path.basename(bitrot_sha512)] + self.exclude_list
+        run_start = ts()
+        from_journal = not (resumed or streaming) and self.journal and self.quick and self.journal_usable(cur)
+        with self.metrics.timer('listing'):
+            if from_journal:
+                paths, paths_uni, total_size = self.list_from_journal(cur, rows, ignored)
+                missing_paths -= paths_uni - {normalize_path(p) for p in paths}  # not checking these today
+            elif leftovers_only:
+                paths = {p: st for p in resumed if (st := get_stat(p)) is not None}
+                total_size = sum(st.st_size for st in paths.values())
+            elif streaming:
+                paths, total_size = {}, 0  # see hash_stream
+            else:
+                paths, total_size = list_existing_paths(
+                    '.',
+                    ignored=ignored,
+                    follow_links=self.follow_links,
+                    verbosity=self.verbosity
+                )
+        if not from_journal:
+            # Without a full listing we can't tell if a file has gone, so can't spot renames
+            paths_uni = None if leftovers_only or streaming else {normalize_path(p) for p in paths}
+        # Rows stored with an algorithm that isn't installed here (e.g. --hash xxh3_128 on a computer with xxhash)
+        # can't be checked: keep their hashes as they are, and leave their files alone
+        unavailable = {path for path, row in rows.items() if row.algorithm not in HASH_ALGORITHMS}
+        if unavailable:
+            names = ', '.join(sorted({rows[path].algorithm for path in unavailable}))
+            print(f'warning: not checking {len(unavailable)} files hashed with {names}, which is not installed.',
+                  file=sys.stderr)
+        # Rows stored with a different algorithm get migrated when their files are next hashed
+        old_algorithms = {path: row.algorithm for path, row in rows.items()
+                          if row.algorithm != self.algorithm and path not in unavailable}
+        # Hash new files with an old algorithm too, so renames can still be spotted during migration
+        unknown_algorithm = min(old_algorithms.values(), default=None)
+        if self.provisional_renames and paths_uni is not None:
+            # Big files that have gone missing might have just moved: see compute_one
+            for path, row in rows.items():
+                if row.fingerprint and path not in paths_uni:
+                    self._missing_fingerprints.setdefault((row.size, row.fingerprint), []).append(path)
+        fingerprints_by_size = {}
+        for size, fingerprint in self._missing_fingerprints:
+            fingerprints_by_size.setdefault(size, set()).add(fingerprint)
+        work = []
+        skipped_size = 0
+        for p, st in paths.items():
+            p_uni = normalize_path(p)
+            if p_uni in unavailable:
+                missing_paths.discard(p_uni)
+                skipped_size += st.st_size
+                continue
+            if p_uni in rows and not leftovers_only and not self.in_sublist(p_uni):
+                # (new files are always hashed, so they can be given a sublist)
+                if not self.quick:
+                    # Not doing this sublist today, so not a missing file: just skip it
+                    missing_paths.discard(p_uni)
+                    skipped_size += st.st_size
+                    continue
+                row = rows.get(p_uni)
+                if row and stat_unchanged(st, (row.mtime, row.size, row.inode)):
+                    # Quick mode: not in this sublist and looks the same as last time - don't even look at it
+                    missing_paths.discard(p_uni)
+                    skipped_size += st.st_size
+                    if (row.size, row.inode) != (st.st_size, st.st_ino):
+                        # fill in size and inode for rows stored by an older version
+                        self.queue_write('UPDATE bitrot SET size=?, inode=? WHERE path=?',
+                                         (st.st_size, st.st_ino, p_uni), p_uni)
+                    continue
+                # Quick mode: anything new or changed gets hashed whatever sublist it's in
+            # (missing_paths holds every path in the database at this point)
+            verify_algorithm = old_algorithms.get(p_uni, None if p_uni in missing_paths else unknown_algorithm)
+            if p_uni not in missing_paths and not self.in_sublist(p_uni) and st.st_size in fingerprints_by_size:
+                # New file outside today's sublist: if it's a big one that has moved, don't read it all today
+                item = WorkItem(p, st, verify_algorithm, frozenset(fingerprints_by_size[st.st_size]))
+                self._fingerprinted[p_uni] = item
+                work.append(item)
+            else:
+                work.append(WorkItem(p, st, verify_algorithm))
+        skipped_size += self._unchecked_size
+        # Send the work out in batches of similar size, so we don't pay for a future and a round trip per file
+        work_size = total_size - skipped_size
+        target_size = min(max(work_size // (self.workers * 8), MIN_BATCH_SIZE), MAX_BATCH_SIZE)
+        if streaming:
+            batches = self.hash_stream(
+                self.file_list, lambda p_uni: old_algorithms.get(p_uni, None if p_uni in rows else unknown_algorithm))
+            bar = FileCounter('Hashing files ')
         else:
-            paths, total_size = list_existing_paths(
-                '.',
-                ignored=[bitrot_db, bitrot_sha512] + self.exclude_list,
-                follow_links=self.follow_links,
-                verbosity=self.verbosity
+            batches = self.hash_in_pool(work, target_size)
+            bar = IncrementalBar('Hashing files', max=total_size, suffix='%(percent).1f%%')
+            if not self.test and not leftovers_only:
+                self.save_checkpoint(conn, work)
+        with bar:
+            if self.verbosity and skipped_size:
+                bar.next(skipped_size)
+            window_closed = False
+            try:
+                with self.metrics.timer('hashing'):
+                    self.process_results(conn, batches, rows, hashes, paths_uni, missing_paths, bar,
+                                         new_paths, updated_paths, renamed_paths, errors)
+            except KeyboardInterrupt:
+                # keep what we've done so far: the checkpoint lets the next run carry on from here
+                self.flush_writes(conn)
+                if not self.test:
+                    update_sha512_integrity(conn, (), verbosity=self.verbosity)
+                raise
+            except WindowClosed:
+                # carry on below, to keep what we've done so far and report on it
+                window_closed = True
+                if self.verbosity:
+                    size_txt = human_format(self.hashed_size, binary=True, split_with=' ')
+                    print(f'\nStopping at the end of the time window after reading {size_txt}iB: ' +
+                          ('the rest of the file list was not read' if streaming else
+                           'the next run will carry on from here'))
+            finally:
+                self.pool.shutdown(cancel_futures=True)
+        if streaming:
+            new_paths[:] = dict.fromkeys(new_paths)  # a file list might have named some of them more than once
+        if leftovers_only or streaming or window_closed:
+            missing_paths.clear()  # we didn't get through everything, so we don't know what's missing
+        if streaming:
+            total_size = self.hashed_size
+
+        # Remove deleted files from the database
+        for path in missing_paths:
+            self.queue_write('DELETE FROM bitrot WHERE path=?', (path,), path)
+
+        if not self.test and not window_closed:
+            self.queue_write('DELETE FROM bitrot_checkpoint', ())  # finished!
+            if paths_uni is not None:
+                # everything in the journal up to now has been dealt with
+                self.queue_write('DELETE FROM bitrot_journal WHERE seen <= ?', (run_start,))
+            if paths_uni is not None and not from_journal:
+                self.queue_write("INSERT OR REPLACE INTO bitrot_meta VALUES ('last_full_walk', ?)", (run_start,))
+        self.flush_writes(conn)
+
+        if not self.test:
+            with self.metrics.timer('committing'):
+                compact_database(conn, self.verbosity)
+                # get everything into the main file, so copies of it (e.g. on other nodes) are complete
+                cur.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+                # and leave WAL mode, so opening the copies read-only doesn't make -wal and -shm files next to them
+                with contextlib.suppress(sqlite3.OperationalError):  # locked: watch_folders has it open
+                    cur.execute('PRAGMA journal_mode=DELETE').fetchall()
+
+        if self.verbosity:
+            cur.execute('SELECT COUNT(path) FROM bitrot')
+            all_count = cur.fetchone()[0]
+            self.report_done(
+                total_size,
+                all_count,
+                len(errors),
+                new_paths,
+                updated_paths,
+                renamed_paths,
+                list(missing_paths),
             )
-        paths_uni = {normalize_path(p) for p in paths}
-        futures = [self.pool.submit(compute_one, p, self.chunk_size, self.sublist_count, self.sublist_index)
-                   for p in paths]
-        with IncrementalBar('Hashing files', max=total_size, suffix='%(percent).1f%%') as bar:
-            for future in as_completed(futures):
-                try:
-                    p_uni, new_size, new_mtime, new_sha1 = future.result()
-                except BitrotException:
-                    continue
 
-                current_size += new_size
-                if self.verbosity:
-                    bar.next(new_size)
-                    # self.report_progress(current_size, total_size, p_uni)
+        if not self.test:
+            with self.metrics.timer('committing'):
+                # the bucket digests are up to date already (see flush_writes): this just writes the .sha512 file
+                update_sha512_integrity(conn, (), verbosity=self.verbosity)
+
+        if self.metrics_file:
+            write_metrics(self.metrics_file, self.metrics.as_dict(
+                node=node(), folder=os.getcwd(), sublist=f'{self.sublist_index}/{self.sublist_count}',
+                quick=self.quick, algorithm=self.algorithm, resumed=bool(resumed), window_closed=window_closed,
+                files_listed=len(paths), bytes_listed=total_size,
+                files_hashed=self.hashed_count, bytes_hashed=self.hashed_size,
+                errors=len(errors), new=len(new_paths), updated=len(updated_paths),
+                renamed=len(renamed_paths), missing=len(missing_paths),
+            ))
 
-                if new_sha1 is None:
-                    # Didn't compute hash because we weren't doing this sublist
-                    # Not a missing file, just skip it and move on
-                    missing_paths.discard(p_uni)
+        if errors:
+            raise BitrotException(1, f'There were {len(errors)} errors found.', errors)
+
+    def journal_usable(self, cur):
+        """Return True if the journal kept by watch_folders can be trusted instead of listing everything.
+        That's if the watcher is still going, started before the last full walk, and the last full walk
+        was within `full_walk_days`: walking every so often catches anything the watcher missed."""
+        meta = dict(cur.execute('SELECT name, value FROM bitrot_meta').fetchall())
+        since, heartbeat, last_walk = (meta.get(name) for name in ('journal_since', 'journal_heartbeat',
+                                                                    'last_full_walk'))
+        usable = (since and heartbeat and last_walk and since <= last_walk
+                  and heartbeat >= ts(ago=JOURNAL_HEARTBEAT * 3)
+                  and last_walk >= ts(ago=datetime.timedelta(days=self.full_walk_days)))
+        if self.verbosity:
+            print('Using the change journal instead of listing files' if usable else 'Listing all files')
+        return bool(usable)
+
+    def list_from_journal(self, cur, rows, ignored):
+        """Work out what's in the folder from the database and the journal, without listing it all.
+        Return a tuple of (paths, paths_uni, total_size) where `paths` is a dict of the paths to look at
+        (files in the journal, and those in today's sublist) and their stat results, and `paths_uni` is
+        a set of the Unicode paths that should be there now, which is used for spotting renames."""
+        excluded = compile_wildcards(ignored)
+        paths = {}
+        believed = set(rows)  # what we think is there
+        for path, event in cur.execute('SELECT path, event FROM bitrot_journal').fetchall():
+            if excluded and any(excluded.match(part) for part in path.split(os.path.sep)[1:]):
+                continue
+            if event == 'changed':
+                st = get_stat(path, follow_links=self.follow_links)
+                if st is not None and stat.S_ISREG(st.st_mode):
+                    paths[path] = st
+                    believed.add(normalize_path(path))
+                else:
+                    believed.discard(normalize_path(path))
+            elif event == 'changed_dir':  # e.g. moved in from somewhere else: its contents weren't reported
+                dir_paths, _ = list_existing_paths(path, ignored, verbosity=0, follow_links=self.follow_links)
+                paths.update(dir_paths)
+                believed.update(normalize_path(p) for p in dir_paths)
+            else:  # deleted or deleted_dir: make sure it's gone
+                prefix = normalize_path(path) + os.path.sep
+                gone = [normalize_path(path)] if event == 'deleted' else [p for p in rows if p.startswith(prefix)]
+                believed.difference_update(p for p in gone if get_stat(p) is None)
+        sizes = {p: (rows[p].size or 0) if p in rows else 0 for p in believed}
+        sizes.update((normalize_path(p), st.st_size) for p, st in paths.items())
+        for path in believed:
+            if path in rows and path not in paths and self.in_sublist(path):
+                # today's sublist. If a file isn't there, it might have a name that normalize_path changed:
+                # leave it be, and a full walk will sort it out
+                if (st := get_stat(path, follow_links=self.follow_links)) is not None:
+                    paths[path] = st
+        checked = {normalize_path(p) for p in paths}
+        self._unchecked_size = sum(size for p, size in sizes.items() if p not in checked)
+        return paths, believed, sum(sizes.values())
+
+    def process_results(self, conn, batches, rows, hashes, paths_uni, missing_paths, bar,
+                        new_paths, updated_paths, renamed_paths, errors):
+        """Compare the lists of FileResults from `batches` (from hash_in_pool or hash_stream) with the
+        database `rows`.
+        Paths and errors are added to the lists passed in, and the database writes needed are queued."""
+        for results in batches:
+            for result in results:
+                p_uni = result.path
+                old_path = result.hash is None and self.handle_moved_path(result, rows, hashes, missing_paths)
+                if result.hash is None and not old_path:
+                    # another file has already been matched with the missing one: hash this in full after all,
+                    # back in the pool with the rest
+                    self.hashed_size += min(result.size, 2 * FINGERPRINT_SIZE)
+                    self._rehash.append(self._fingerprinted.pop(p_uni)._replace(fingerprints=None))
                     continue
+                if self.verbosity:
+                    bar.next(result.size)
+                if not self.test:
+                    self.queue_write('UPDATE bitrot_checkpoint SET verified=? WHERE path=?', (ts(), p_uni))
+                if old_path:
+                    self.hashed_size += min(result.size, 2 * FINGERPRINT_SIZE)
+                    renamed_paths.append((old_path, p_uni))
+                    self.maybe_commit(conn)
+                    continue
+                _, new_size, new_mtime, new_inode, new_hash, _, verify_hash, fingerprint = result
+                self.hashed_size += new_size
+                self.hashed_count += 1
 
                 if p_uni not in missing_paths:
                     # We are not expecting this path, it wasn't in the database yet.
                     # It's either new or a rename. Let's handle that.
                     stored_path = self.handle_unknown_path(
-                        cur, p_uni, new_mtime, new_sha1, paths_uni, hashes
+                        p_uni, new_mtime, new_hash, paths_uni, hashes, new_size, new_inode, verify_hash, fingerprint
                     )
                     self.maybe_commit(conn)
                     if p_uni == stored_path:
@@ -320,82 +1298,57 @@ class Bitrot(object):
 
                 # At this point we know we're seeing an expected file. Try to compare hashes.
                 missing_paths.discard(p_uni)
-                cur.execute('SELECT mtime, hash, timestamp FROM bitrot WHERE path=?', (p_uni,))
-                row = cur.fetchone()
-                if not row:
-                    print(
-                        '\rwarning: path disappeared from the database while running:',
-                        p_uni,
-                        file=sys.stderr,
-                    )
-                    continue
-
-                stored_mtime, stored_sha1, stored_ts = row
+                (stored_mtime, stored_hash, stored_ts, stored_size, stored_inode, stored_algorithm,
+                 stored_fingerprint) = rows[p_uni]
                 if int(stored_mtime) != new_mtime:
                     # File has been updated: update the hash in the database
                     updated_paths.append(p_uni)
-                    cur.execute('UPDATE bitrot SET mtime=?, hash=?, timestamp=? WHERE path=?',
-                                (new_mtime, new_sha1, ts(), p_uni))
+                    self.queue_write('UPDATE bitrot SET mtime=?, hash=?, timestamp=?, size=?, inode=?, '
+                                     'algorithm=?, fingerprint=? WHERE path=?',
+                                     (new_mtime, new_hash, ts(), new_size, new_inode, self.algorithm, fingerprint,
+                                      p_uni),
+                                     p_uni)
                     self.maybe_commit(conn)
                     continue
 
-                if stored_sha1 != new_sha1:
+                if stored_algorithm not in HASH_ALGORITHMS:
+                    continue  # from a file list: there's nothing to check it against here (see run)
+                check_hash = new_hash if stored_algorithm == self.algorithm else verify_hash
+                if stored_hash != check_hash:
                     # Hashes are different! Report a mismatch
                     errors.append(p_uni)
                     print(
-                        f'\rerror: SHA1 mismatch for {p_uni}: expected {stored_sha1}, got {new_sha1}. '
-                        f'Last good hash checked on {stored_ts}.',
+                        f'\rerror: {stored_algorithm} mismatch for {p_uni}: expected {stored_hash}, '
+                        f'got {check_hash}. Last good hash checked on {stored_ts}.',
                         file=sys.stderr,
                     )
-        # Remove deleted files from the database
-        for path in missing_paths:
-            cur.execute('DELETE FROM bitrot WHERE path=?', (path,))
-
-        conn.commit()
-
-        if not self.test:
-            cur.execute('vacuum')
-
-        if self.verbosity:
-            cur.execute('SELECT COUNT(path) FROM bitrot')
-            all_count = cur.fetchone()[0]
-            self.report_done(
-                total_size,
-                all_count,
-                len(errors),
-                new_paths,
-                updated_paths,
-                renamed_paths,
-                list(missing_paths),
-            )
-
-        update_sha512_integrity(verbosity=self.verbosity)
-
-        if errors:
-            raise BitrotException(1, f'There were {len(errors)} errors found.', errors)
-
-    def select_all_paths(self, cur):
-        """Return a set of all distinct paths in the bitrot database.
-
-        The paths are Unicode and are normalized if FSENCODING was UTF-8.
-        """
-        result = set()
-        cur.execute('SELECT path FROM bitrot')
-        while row := cur.fetchone():
-            result.add(row[0])
-        return result
+                elif stored_algorithm != self.algorithm:
+                    # Verified with the old algorithm, so now we can store the new one
+                    self.queue_write('UPDATE bitrot SET hash=?, algorithm=?, size=?, inode=?, fingerprint=? '
+                                     'WHERE path=?',
+                                     (new_hash, self.algorithm, new_size, new_inode, fingerprint, p_uni), p_uni)
+                    self.maybe_commit(conn)
+                elif (stored_size, stored_inode, stored_fingerprint) != (new_size, new_inode, fingerprint):
+                    # Same contents but a new inode (e.g. replaced by a sync tool): remember it for quick mode
+                    self.queue_write('UPDATE bitrot SET size=?, inode=?, fingerprint=? WHERE path=?',
+                                     (new_size, new_inode, fingerprint, p_uni), p_uni)
+            self.maybe_commit(conn)  # so the checkpoint keeps up even if nothing has changed
 
-    def select_all_hashes(self, cur):
-        """Return a dict where keys are hashes and values are sets of paths.
+    def select_all(self, cur):
+        """Read the whole bitrot table in one go, and return a tuple of two dicts.
+        In the first, keys are paths and values are StoredRows.
+        In the second, keys are hashes and values are sets of paths.
 
         The paths are Unicode and are normalized if FSENCODING was UTF-8.
         """
-        result = {}
-        cur.execute('SELECT hash, path FROM bitrot')
-        while row := cur.fetchone():
-            rhash, rpath = row
-            result.setdefault(rhash, set()).add(rpath)
-        return result
+        rows = {}
+        hashes = {}
+        cur.execute('SELECT path, mtime, hash, timestamp, size, inode, coalesce(algorithm, ?), fingerprint FROM bitrot',
+                    (DEFAULT_ALGORITHM,))
+        for path, *row in cur:
+            rows[path] = StoredRow(*row)
+            hashes.setdefault(row[1], set()).add(path)
+        return rows, hashes
 
     def report_progress(self, current_size, total_size, current_path):
         size_fmt = '\r{:>6.1%}'.format(current_size / (total_size or 1))
@@ -426,9 +1379,11 @@ class Bitrot(object):
         """Print a report on what happened.  All paths should be Unicode here."""
         size_txt = human_format(total_size, binary=True, split_with=' ')
         report = f'Finished. {size_txt}iB of files in folder. {error_count} errors found.'
+        size_txt = human_format(self.hashed_size, binary=True, split_with=' ')
         if self.sublist_count > 1:
-            size_txt = human_format(total_size / self.sublist_count, binary=True, split_with=' ')
-            report += f' Checked sublist {self.sublist_index} of {self.sublist_count}: approx {size_txt}iB.'
+            report += f' Checked sublist {self.sublist_index} of {self.sublist_count}: {size_txt}iB read.'
+        else:
+            report += f' {size_txt}iB read.'
         # pad out with spaces, otherwise previous filenames won't be erased
         report += ' ' * (get_terminal_width() - len(report))
         print('\r' + report)
@@ -452,42 +1407,83 @@ class Bitrot(object):
         if self.test and self.verbosity:
             print('warning: database file not updated on disk (test mode).')
 
-    def handle_unknown_path(self, cur, new_path, new_mtime, new_sha1, paths_uni, hashes):
+    def handle_moved_path(self, result, rows, hashes, missing_paths):
+        """Treat a new file as a provisional rename of a missing file with the same size and fingerprint.
+        `result` is a FileResult without a hash. The stored hash is kept as it is, and gets checked
+        against the file when its sublist comes up. The write is queued up for the next flush_writes.
+
+        Returns the old Unicode path, or None if every missing file that matches has already been
+        claimed by another new file."""
+        candidates = self._missing_fingerprints.get((result.size, result.fingerprint), [])
+        old_path = next((path for path in candidates if path in missing_paths), None)
+        if old_path is None:
+            return None
+        self.queue_write(
+            'UPDATE bitrot SET mtime=?, path=?, size=?, inode=?, bucket=? WHERE path=?',
+            (result.mtime, result.path, result.size, result.inode, path_bucket(result.path), old_path),
+            old_path, result.path,
+        )
+        missing_paths.discard(old_path)
+        hashes[rows[old_path].hash].discard(old_path)  # so a copy can't be a rename of it too
+        return old_path
+
+    def handle_unknown_path(self, new_path, new_mtime, new_hash, paths_uni, hashes,
+                            new_size=None, new_inode=None, verify_hash=None, fingerprint=None):
         """Either add a new entry to the database or update the existing entry
-        on rename.
+        on rename. The write is queued up for the next flush_writes.
 
-        `cur` is the database cursor. `new_path` is the new Unicode path.
-        `paths_uni` are Unicode paths seen on disk during this run of Bitrot.
+        `new_path` is the new Unicode path.
+        `paths_uni` are Unicode paths seen on disk during this run of Bitrot, or None if the
+        disk wasn't listed, in which case renames can't be detected.
         `hashes` is a dictionary selected from the database, keys are hashes, values
         are sets of Unicode paths that are stored in the DB under the given hash.
+        `verify_hash` is the hash of the new path using an older algorithm, which is
+        used to find renames of files that haven't been migrated to the new algorithm yet.
 
         Returns `new_path` if the entry was indeed new or the `old_path` (e.g.
         outdated path stored in the database for this hash) if there was a rename.
         """
 
-        for old_path in hashes.get(new_sha1, ()):
-            if old_path not in paths_uni:
-                # File of the same hash used to exist but no longer does.
-                # Let's treat `new_path` as a renamed version of that `old_path`.
-                cur.execute(
-                    'UPDATE bitrot SET mtime=?, path=?, timestamp=? WHERE path=?',
-                    (new_mtime, new_path, ts(), old_path),
-                )
-                return old_path
+        for stored_hash in (new_hash, verify_hash) if paths_uni is not None else ():
+            for old_path in hashes.get(stored_hash, ()):
+                if old_path not in paths_uni:
+                    # File of the same hash used to exist but no longer does.
+                    # Let's treat `new_path` as a renamed version of that `old_path`.
+                    self.queue_write(
+                        'UPDATE bitrot SET mtime=?, path=?, timestamp=?, size=?, inode=?, hash=?, algorithm=?, '
+                        'bucket=?, fingerprint=? WHERE path=?',
+                        (new_mtime, new_path, ts(), new_size, new_inode, new_hash, self.algorithm,
+                         path_bucket(new_path), fingerprint, old_path),
+                        old_path, new_path,
+                    )
+                    hashes[stored_hash].discard(old_path)  # so another copy can't be a rename of it too
+                    return old_path
 
-        # Either we haven't found `new_sha1` at all in the database, or all
+        # Either we haven't found `new_hash` at all in the database, or all
         # currently stored paths for this hash still point to existing files.
-        # Let's insert a new entry for what appears to be a new file.
-        cur.execute(
-            'INSERT INTO bitrot VALUES (?, ?, ?, ?)',
-            (new_path, new_mtime, new_sha1, ts()),
+        # Let's insert a new entry for what appears to be a new file. (OR REPLACE: a file list can name the
+        # same new file twice, and the first one's row is still waiting in _pending_writes.)
+        self.queue_write(
+            'INSERT OR REPLACE INTO bitrot (path, mtime, hash, timestamp, size, inode, algorithm, bucket, fingerprint, '
+            'sublist) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (new_path, new_mtime, new_hash, ts(), new_size, new_inode, self.algorithm, path_bucket(new_path),
+             fingerprint, self.new_sublist(new_path, new_size or 0)),
+            new_path,
         )
         return new_path
 
 
-def get_path(directory='.', ext='db'):
-    """Compose the path to the selected bitrot file."""
-    return os.path.join(directory, f'.bitrot-{node()}.{ext}')
+def get_path(directory='.', ext='db', node_name=None):
+    """Compose the path to the selected bitrot file, for this computer unless `node_name` is given."""
+    return os.path.join(directory, f'.bitrot-{node_name or node()}.{ext}')
+
+
+def read_only_uri(db_file, node_name=None):
+    """Return a URI for opening a bitrot database read-only, from this computer's unless `node_name` is given.
+    Another node's copy is opened as immutable, since nothing here writes to it: otherwise SQLite can make
+    -wal and -shm files next to it, which then get synced."""
+    mode = 'mode=ro' if node_name in (None, node()) else 'immutable=1'
+    return 'file:' + pathname2url(os.path.abspath(db_file)) + '?' + mode
 
 
 def stable_sum(bitrot_db=None):
@@ -506,7 +1502,58 @@ def stable_sum(bitrot_db=None):
     return digest.hexdigest()
 
 
-def check_sha512_integrity(verbosity=1):
+def benchmark_hashing(file_count=200, big_file_count=4, big_file_size=256 * 1024 * 1024,
+                      algorithm=DEFAULT_ALGORITHM, repeats=3):
+    """Time each of the hashing modes on a synthetic tree of small and big files, and print the throughput.
+    Everything is hashed once before timing starts, so all the modes are reading from the OS cache."""
+    with tempfile.TemporaryDirectory(prefix='bitrot_benchmark_') as directory:
+        paths = []
+        for i in range(file_count + big_file_count):
+            size = big_file_size if i < big_file_count else (i * 37 % 1000 + 1) * 1024  # 1 kiB to 1 MiB
+            path = os.path.join(directory, f'{i}.bin')
+            with open(path, 'wb') as f:
+                for offset in range(0, size, MAX_CHUNK_SIZE):
+                    f.write(os.urandom(min(MAX_CHUNK_SIZE, size - offset)))
+            paths.append(path)
+        total_size = sum(os.path.getsize(path) for path in paths)
+        print(f'{len(paths)} files, {human_format(total_size, binary=True, split_with=" ")}iB, {algorithm}')
+        expected = [hash_file(path, DEFAULT_CHUNK_SIZE, (algorithm,), 'read') for path in paths]
+        for mode, chunk_size in [('read', DEFAULT_CHUNK_SIZE)] + [(mode, 0) for mode in HASH_MODES]:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                result = [hash_file(path, chunk_size, (algorithm,), mode) for path in paths]
+            elapsed = (time.perf_counter() - start) / repeats
+            assert result == expected, f'{mode} mode gave different hashes'
+            rate = human_format(total_size / elapsed, precision=1, binary=True, split_with=' ')
+            print(f'{mode:>8} chunk size {chunk_size or "auto":>5}: {elapsed:.3f}s, {rate}iB/s')
+
+
+def bucket_digest(cur, bucket):
+    """Return the SHA-512 of all the rows in an integrity bucket."""
+    digest = hashlib.sha512()
+    cur.execute('SELECT path, mtime, hash, timestamp, size, inode, algorithm FROM bitrot '
+                'WHERE bucket=? ORDER BY path', (bucket,))
+    for row in cur:
+        digest.update(('\0'.join(map(str, row)) + '\n').encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+def root_digest(cur):
+    """Return the SHA-512 of all the stored bucket digests: this is what goes in the .sha512 file."""
+    digest = hashlib.sha512()
+    cur.execute('SELECT digest FROM bitrot_integrity ORDER BY bucket')
+    for bucket_hash, in cur:
+        digest.update(bucket_hash.encode('ascii'))
+    return digest.hexdigest().encode('ascii')
+
+
+def check_sha512_integrity(conn=None, verbosity=1, full=False, part=None):
+    """Check the database against the .sha512 file.
+
+    The database keeps a digest of the rows in each of INTEGRITY_BUCKETS buckets, and the .sha512
+    file holds a digest of those. The digests of some of the buckets are worked out again from their
+    rows too: `part` is (index, count) to pick one of `count` slices of them, by default a different
+    slice each day, so every row gets read over INTEGRITY_CHECK_DAYS. With `full`, all of them are."""
     sha512_path = get_path(ext='sha512')
     if not os.path.exists(sha512_path):
         return
@@ -516,17 +1563,24 @@ def check_sha512_integrity(verbosity=1):
         sys.stdout.flush()
     with open(sha512_path, 'rb') as f:
         old_sha512 = f.read().strip()
-    bitrot_db = get_path()
-    digest = hashlib.sha512()
-    with open(bitrot_db, 'rb') as f:
-        digest.update(f.read())
-    new_sha512 = digest.hexdigest().encode('ascii')
-    if new_sha512 != old_sha512:
+    conn = conn or get_sqlite3_cursor(get_path())
+    cur = conn.cursor()
+    if full:
+        buckets = range(INTEGRITY_BUCKETS)
+    else:
+        index, count = part or (datetime.date.today().toordinal() % INTEGRITY_CHECK_DAYS, INTEGRITY_CHECK_DAYS)
+        buckets = range(index % count, INTEGRITY_BUCKETS, count)
+    stored = dict(cur.execute('SELECT bucket, digest FROM bitrot_integrity').fetchall())
+    bad_buckets = [bucket for bucket in buckets if stored.get(bucket) != bucket_digest(cur, bucket)]
+    new_sha512 = root_digest(cur)
+    if new_sha512 != old_sha512 or bad_buckets:
         if verbosity:
-            if len(old_sha512) == 128:
-                print("error: SHA512 of the file is different, bitrot.db might be corrupt.")
+            if bad_buckets:
+                print(f"error: {len(bad_buckets)} buckets don't match their stored digests, bitrot.db might be corrupt.")
+            elif len(old_sha512) == 128:
+                print("error: SHA512 of the bucket digests is different, bitrot.db might be corrupt.")
             else:
-                print("error: SHA512 of the file is different but bitrot.sha512 has a suspicious length. "
+                print("error: SHA512 of the bucket digests is different but bitrot.sha512 has a suspicious length. "
                       "It might be corrupt.")
             print("If you'd like to continue anyway, delete the .bitrot.sha512 file and try again.", file=sys.stderr)
         raise BitrotException(3, 'bitrot.db integrity check failed, cannot continue.')
@@ -535,17 +1589,23 @@ def check_sha512_integrity(verbosity=1):
         print('ok.')
 
 
-def update_sha512_integrity(verbosity=1):
+def update_sha512_integrity(conn=None, buckets=None, verbosity=1):
+    """Work out the digests of the given integrity buckets again (all of them if `buckets` is None,
+    or if they haven't all been stored yet), and update the .sha512 file if that changes anything."""
+    conn = conn or get_sqlite3_cursor(get_path())
+    cur = conn.cursor()
+    stored_count, = cur.execute('SELECT COUNT(*) FROM bitrot_integrity').fetchall()[0]
+    if buckets is None or stored_count < INTEGRITY_BUCKETS:
+        buckets = range(INTEGRITY_BUCKETS)
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO bitrot_integrity VALUES (?, ?)',
+                         [(bucket, bucket_digest(cur, bucket)) for bucket in buckets])
     old_sha512 = 0
     sha512_path = get_path(ext='sha512')
     if os.path.exists(sha512_path):
         with open(sha512_path, 'rb') as f:
             old_sha512 = f.read().strip()
-    bitrot_db = get_path()
-    digest = hashlib.sha512()
-    with open(bitrot_db, 'rb') as f:
-        digest.update(f.read())
-    new_sha512 = digest.hexdigest().encode('ascii')
+    new_sha512 = root_digest(cur)
     if new_sha512 != old_sha512:
         if verbosity:
             print(f'Updating {sha512_path} ... ', end='')
@@ -593,10 +1653,67 @@ def run_from_command_line():
              '(0 commits on every operation)')
     parser.add_argument(
         '-w', '--workers', type=int, default=os.cpu_count(),
-        help='run this many workers (use -w1 for slow magnetic disks)')
+        help='run this many workers')
+    parser.add_argument(
+        '--device-workers', type=int, default=0,
+        help='let at most this many workers read from each disk at once (default: '
+             '1 for spinning disks, where it can be detected, otherwise all of them)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=0,
+        help='read files this many bytes at a time (default: choose from the '
+             'file system block size and the file size)')
+    parser.add_argument(
+        '--hash-mode', default='auto', choices=HASH_MODES,
+        help='how to read files: readinto reuses a single buffer (auto does the same) and mmap maps '
+             'files into memory. mmap can be a little faster, but a bad sector kills the worker '
+             'rather than being reported')
     parser.add_argument(
-        '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
-        help='read files this many bytes at a time')
+        '--benchmark', action='store_true',
+        help='time each of the hash modes on a temporary tree of synthetic files')
+    parser.add_argument(
+        '--hash', default=DEFAULT_ALGORITHM, choices=list(HASH_ALGORITHMS),
+        help='hash new and updated files with this algorithm. Entries stored with a '
+             'different algorithm are checked with that one and then migrated when '
+             'their sublist comes up')
+    parser.add_argument(
+        '--quick', action='store_true',
+        help="don't read files outside today's sublist unless their size, "
+             "modification time or inode have changed since the last run")
+    parser.add_argument(
+        '--duplicates', nargs='*', metavar='FOLDER',
+        help="using only the data already gathered, report duplicate files in this folder "
+             "(or the given ones, with bitrot databases of their own) and the space they waste")
+    parser.add_argument(
+        '--dedupe', choices=('hardlink', 'trash'),
+        help='with --duplicates, replace extra copies with hard links to the first one, or send them '
+             'to the recycle bin. Copies in folders given first are kept. Use with -t to see what would happen')
+    parser.add_argument(
+        '--full-renames', action='store_true',
+        help="hash moved files in full straight away. Otherwise a big new file outside today's sublist "
+             "whose size and fingerprint (first and last MiB) match a missing file is taken to be that file, "
+             "and checked in full when its own sublist comes up")
+    parser.add_argument(
+        '--metrics', default='',
+        help='save timings and throughput (per disk too) to this file after the run: a line of JSON '
+             "is added to it, or if it ends in .prom it's written for the node exporter's textfile collector")
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='keep running, and record files that change in a journal so --journal runs can skip listing '
+             'every file (needs the watchdog package)')
+    parser.add_argument(
+        '--journal', action='store_true',
+        help='with --quick, use the journal kept by --watch rather than listing every file, as long as '
+             'the watcher is running and there has been a full listing since it started')
+    parser.add_argument(
+        '--full-walk-days', type=float, default=7,
+        help='with --journal, list every file anyway if the last full listing was this many days ago')
+    parser.add_argument(
+        '--max-rate', type=float, default=0,
+        help='read no more than this many MB per second, across all the workers (default: no limit)')
+    parser.add_argument(
+        '--window', default='',
+        help='only read files between these times, e.g. 22:00-07:00. A run that goes on past the end '
+             'stops cleanly, and the next one carries on where it left off')
     parser.add_argument(
         '--fsencoding', default='',
         help='override the codec to decode filenames, otherwise taken from '
@@ -609,7 +1726,20 @@ def run_from_command_line():
         help="don't read the files listed in this file - wildcards are allowed")
 
     args = parser.parse_args()
-    if args.sum:
+    if args.benchmark:
+        benchmark_hashing(algorithm=args.hash)
+    elif args.watch:
+        try:
+            watch_folders(['.'])
+        except KeyboardInterrupt:
+            pass
+        except BitrotException as bre:
+            print('error:', bre.args[1], file=sys.stderr)
+            sys.exit(bre.args[0])
+    elif args.duplicates is not None:
+        find_wasted_space(args.duplicates or ['.'], action=args.dedupe,
+                          verbosity=0 if args.quiet else 2 if args.verbose else 1, test=args.test)
+    elif args.sum:
         try:
             print(stable_sum())
         except RuntimeError as e:
@@ -636,19 +1766,29 @@ def run_from_command_line():
             exclude_list = read_exclude_list(args.exclude_list)
         else:
             exclude_list = []
-        bt = Bitrot(
-            verbosity=verbosity,
-            test=args.test,
-            follow_links=args.follow_links,
-            commit_interval=args.commit_interval,
-            chunk_size=args.chunk_size,
-            workers=args.workers,
-            file_list=file_list,
-            exclude_list=exclude_list,
-        )
         if args.fsencoding:
             FSENCODING = args.fsencoding
         try:
+            bt = Bitrot(
+                verbosity=verbosity,
+                test=args.test,
+                follow_links=args.follow_links,
+                commit_interval=args.commit_interval,
+                chunk_size=args.chunk_size,
+                workers=args.workers,
+                file_list=file_list,
+                exclude_list=exclude_list,
+                quick=args.quick,
+                algorithm=args.hash,
+                hash_mode=args.hash_mode,
+                device_workers=args.device_workers,
+                provisional_renames=not args.full_renames,
+                metrics_file=args.metrics or None,
+                journal=args.journal,
+                full_walk_days=args.full_walk_days,
+                max_rate=args.max_rate,
+                window=args.window or None,
+            )
             bt.run()
         except BitrotException as bre:
             print('error:', bre.args[1], file=sys.stderr)
@@ -659,10 +1799,79 @@ def read_exclude_list(exclude_list):
     return [line.rstrip('\n') for line in open(exclude_list)]
 
 
-def check_folders_for_bitrot(verbosity=1, sublist_count=60):
-    """Go through the list of folders, checking each one for bitrot."""
+def watch_folders(directories=check_folders):
+    """Keep a journal of files that are created, changed, moved or deleted in the given folders, in the
+    bitrot_journal table of each one's database, until interrupted. Runs with journal=True can then
+    use that rather than listing every file. Needs the watchdog package."""
+    if Observer is None:
+        raise BitrotException(2, 'Watching folders needs watchdog: pip install watchdog')
+    events = queue.Queue()  # (folder, path, event)
+
+    class JournalHandler(FileSystemEventHandler):
+        def __init__(self, folder):
+            self.folder = folder
+
+        def record(self, path, event):
+            path = os.path.join('.', os.path.relpath(os.fsdecode(path), self.folder))
+            if not os.path.basename(path).startswith('.bitrot-'):  # our own databases change all the time
+                events.put((self.folder, path, event))
+
+        def on_any_event(self, event):
+            suffix = '_dir' if event.is_directory else ''
+            if event.event_type in ('created', 'modified', 'closed'):
+                if not event.is_directory or event.event_type == 'created':
+                    self.record(event.src_path, 'changed' + suffix)
+            elif event.event_type == 'deleted':
+                self.record(event.src_path, 'deleted' + suffix)
+            elif event.event_type == 'moved':
+                self.record(event.src_path, 'deleted' + suffix)
+                self.record(event.dest_path, 'changed' + suffix)
+
+    connections = {}
+    observer = Observer()
+    for folder in directories:
+        folder = os.path.abspath(folder)
+        conn = get_sqlite3_cursor(get_path(folder))
+        tune_connection(conn)
+        conn.execute('PRAGMA busy_timeout=60000')  # wait for Bitrot.run to finish writing
+        with conn:
+            # anything before now wasn't seen, so the journal can't be used until the next full walk
+            conn.execute("INSERT OR REPLACE INTO bitrot_meta VALUES ('journal_since', ?)", (ts(),))
+        connections[folder] = conn
+        observer.schedule(JournalHandler(folder), folder, recursive=True)
+        print('Watching', folder)
+    observer.start()
+    try:
+        while True:
+            # gather up events for a few seconds after the first one, and write them all at once
+            batch = {}  # (folder, path): latest event
+            deadline = None
+            with contextlib.suppress(queue.Empty):
+                while True:
+                    timeout = JOURNAL_HEARTBEAT.total_seconds() if deadline is None else deadline - time.monotonic()
+                    folder, path, event = events.get(timeout=max(timeout, 0))
+                    batch[folder, path] = event
+                    deadline = deadline or time.monotonic() + 5
+            seen = ts()
+            for folder, conn in connections.items():
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO bitrot_journal VALUES (?, ?, ?)',
+                                     [(path, event, seen) for (event_folder, path), event in batch.items()
+                                      if event_folder == folder])
+                    conn.execute("INSERT OR REPLACE INTO bitrot_meta VALUES ('journal_heartbeat', ?)", (seen,))
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def check_folders_for_bitrot(verbosity=1, sublist_count=60, quick=True, algorithm=DEFAULT_ALGORITHM,
+                             max_rate=0, window=None):
+    """Go through the list of folders, checking each one for bitrot.
+    `max_rate` (MB/s) and `window` (e.g. '22:00-07:00') keep the reading in the background.
+    Every node should use the same `algorithm`: clashes are only found between rows hashed the same way."""
     script_dir = os.path.split(__file__)[0]
     os.chdir(script_dir)
+    metrics_file = os.path.abspath(f'bitrot-metrics-{node()}.jsonl')  # one line per folder per run
     exclude_list = read_exclude_list('exclude.txt')
     toast = ''
     error_file_handle = open(f'bitrot-errors-{node()}.txt', 'a', encoding='utf-8')  # always append - don't overwrite sublist errors
@@ -670,75 +1879,319 @@ def check_folders_for_bitrot(verbosity=1, sublist_count=60):
         print(folder)
         os.chdir(folder)
         try:
-            Bitrot(exclude_list=exclude_list, verbosity=verbosity, sublist_count=sublist_count).run()
+            Bitrot(exclude_list=exclude_list, verbosity=verbosity, sublist_count=sublist_count, quick=quick,
+                   algorithm=algorithm, metrics_file=metrics_file, journal=True,
+                   max_rate=max_rate, window=window).run()
         except BitrotException as exception:
             # Found some errors. Report on them in the error file.
             bad_files = [os.path.join(folder, file) for file in exception.args[2]]
             error_file_handle.write(f'Bad files in {folder}:\n' + '\n'.join(bad_files) + '\n')
             toast += f'{folder}: {len(bad_files)} bad files\n'
         # Check for clashes across all files (not just this sublist)
-        # clashes = compare_nodes()
-        # if clashes:
-        #     error_file_handle.write(f'Clashes in {folder}:\n' + '\n'.join(clashes) + '\n')
-        #     toast += f'{folder}: {len(clashes)} clashes\n'
+        clashes = compare_nodes(report=True)
+        if clashes:
+            error_file_handle.write(f'Clashes in {folder}:\n' + '\n'.join(clashes) + '\n')
+            toast += f'{folder}: {len(clashes)} clashes\n'
     return toast
 
 
-def restore_good_files():
-    """Go through a bitrot-errors file produced on another computer.
-    We assume the copies on this computer are good ones.
-    Make a copy of each good file by appending .restored to the file basename.
-    The originals can be deleted on the computer with the bad copy."""
-    for folder in check_folders:
-        os.chdir(folder)
-        for error_list_file in os.listdir('.'):
-            if not (error_list_file.startswith('bitrot-errors-') and error_list_file.endswith('.txt')):
-                continue
-            error_node = error_list_file[14:-4]  # i.e. HAL in bitrot-errors-HAL.txt
-            print('Found error list for', error_node)
-            restoring = error_node != node()
+class RestoreItem(NamedTuple):
+    """A bad file listed in a bitrot-errors file, and where to find its expected hash."""
+    path: str
+    """Where the file is on this computer."""
+    folder: str
+    """The folder on this computer with the bitrot databases for the file."""
+    db_path: str
+    """The path as stored in the databases, relative to `folder`."""
+
+
+def read_error_list(error_list_file):
+    """Return a list of RestoreItems for the bad files in a bitrot-errors file written by
+    check_folders_for_bitrot. Clashes between nodes are left out, as we can't tell which copy is good.
+    Folders are matched to ours by name, as they might be somewhere else on the other computer."""
+    items = []
+    folder = None
+    for line in open(error_list_file, encoding='utf-8').read().splitlines():
+        line = line.replace('\\', '/')  # Linux can't deal with \ but Windows can deal with /
+        if line.startswith(('Bad files in ', 'Clashes in ')) and line.endswith(':'):
+            their_folder = line.split(' in ', 1)[1][:-1]
+            folder = None if line.startswith('Clashes') else their_folder
+            continue
+        if folder is None:
+            continue
+        our_folder = next((f for f in check_folders if os.path.basename(os.path.normpath(f)) ==
+                           os.path.basename(os.path.normpath(folder))), folder)
+        db_path = os.path.join('.', os.path.normpath(os.path.relpath(line, folder)))
+        items.append(RestoreItem(os.path.normpath(os.path.join(our_folder, db_path)), our_folder, db_path))
+    return items
+
+
+def expected_hashes(items, node_name):
+    """Return a dict where keys are RestoreItems and values are tuples of (hash, algorithm)
+    from the given node's databases. Items that aren't in the database are left out."""
+    expected = {}
+    for folder in {item.folder for item in items}:
+        uri = read_only_uri(get_path(folder, node_name=node_name), node_name)
+        with contextlib.closing(sqlite3.connect(uri, uri=True)) as conn:
+            for item in items:
+                if item.folder == folder and (row := conn.execute(
+                        'SELECT hash, coalesce(algorithm, ?) FROM bitrot WHERE path=?',
+                        (DEFAULT_ALGORITHM, normalize_path(item.db_path))).fetchone()):
+                    expected[item] = row
+    return expected
+
+
+def check_file(path, expected):
+    """Check a file against the `expected` (hash, algorithm). Return None if it's good,
+    otherwise a word saying what's wrong, for the audit log."""
+    if expected is None:
+        return 'unknown'  # not in the database
+    h, algorithm = expected
+    if algorithm not in HASH_ALGORITHMS:
+        return f'no {algorithm}'
+    if not os.path.exists(path):
+        return 'missing'
+    if hash_file(path, algorithms=(algorithm,))[0] != h:
+        return 'mismatch'
+    return None
+
+
+def restore_file(source, destination, expected):
+    """Copy `source` to `destination`, but only if it matches the `expected` (hash, algorithm),
+    and check the copy too. Return a word saying what happened, for the audit log."""
+    if problem := check_file(source, expected):
+        return problem
+    temp_file = destination + '.part'  # so a half-finished copy never looks like a good one
+    shutil.copy2(source, temp_file)
+    if check_file(temp_file, expected):
+        os.remove(temp_file)
+        return 'bad copy'
+    os.replace(temp_file, destination)
+    return 'copied'
+
+
+def restored_name(path):
+    """Return the name of the restored copy of a file, with .restored before the extension."""
+    basename, ext = os.path.splitext(path)
+    return f'{basename}.restored{ext}'
+
+
+def restore_good_files(workers=4):
+    """Go through the bitrot-errors files produced on other computers.
+    Make a copy of each good file by appending .restored to the file basename. Our copy is only
+    trusted if it matches the hash the other computer stored before the file went bad.
+    Then on the computer with the bad copy, swap in the restored copies, checking them against the
+    hashes that computer stored.
+    Files are hashed and copied by a pool of `workers` threads, and everything that happens is
+    written to the bitrot-restore log."""
+    script_dir = os.path.split(__file__)[0]
+    os.chdir(script_dir)
+    log = open(f'bitrot-restore-{node()}.log', 'a', encoding='utf-8')
+    for error_list_file in os.listdir('.'):
+        if not (error_list_file.startswith('bitrot-errors-') and error_list_file.endswith('.txt')):
+            continue
+        error_node = error_list_file[14:-4]  # i.e. HAL in bitrot-errors-HAL.txt
+        print('Found error list for', error_node)
+        restoring = error_node != node()
+        if restoring:
+            print('Restoring my copies')
+        else:
+            print('Looking for restored copies')
+
+        items = read_error_list(error_list_file)
+        # either way, the good hash is the one stored by the node with the bad copy
+        expected = expected_hashes(items, error_node)
+
+        def restore(item):
             if restoring:
-                print('Restoring my copies')
-            else:
-                print('Looking for restored copies')
-            for bad_file in open(error_list_file).read().splitlines():
-                bad_file = bad_file.replace('\\', '/')  # Linux can't deal with \ but Windows can deal with /
-                basename, ext = os.path.splitext(bad_file)
-                restored_file = f'{basename}.restored.{ext}'
-                if restoring:
-                    shutil.copy2(bad_file, restored_file)
-                    print('  Made a copy of my', bad_file)
-                else:
-                    if os.path.exists(restored_file):
-                        send2trash(bad_file)
-                        os.rename(restored_file, bad_file)
-                        print('  Restored', bad_file)
-                    else:
-                        print('  No good copy found of', bad_file)
+                return restore_file(item.path, restored_name(item.path), expected.get(item))
+            restored_file = restored_name(item.path)
+            if not os.path.exists(restored_file):
+                return 'no good copy'
+            if problem := check_file(restored_file, expected.get(item)):
+                return problem
+            send2trash(item.path)
+            os.replace(restored_file, item.path)
+            return 'restored'
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(restore, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    status = future.result()
+                except OSError as ex:
+                    status = f'error: {ex.strerror}'
+                print(f'  {status}: {item.path}')
+                log.write(f'{ts()}\t{error_node}\t{"copy" if restoring else "swap"}\t{status}\t{item.path}\n')
+                log.flush()
+    log.close()
+
+
+def node_databases():
+    """Return a dict of the bitrot databases in the current folder, where keys are node names."""
+    return {db_file[8:-3]: db_file for db_file in sorted(os.listdir())
+            if db_file.startswith('.bitrot-') and db_file.endswith('.db')}
+
+
+def find_clashes(databases):
+    """Look for paths whose hashes differ between the node databases given in a dict, as returned
+    by node_databases. Yield tuples of (path, algorithm, node, hash, other_node, other_hash) as they
+    are found.
+
+    All the databases are attached read-only to one connection, and compared in pairs by joining on
+    their path index, so nothing much is held in memory however many files there are.
+    Only hashes made with the same algorithm are compared."""
+    conn = sqlite3.connect('file::memory:', uri=True)  # uri=True lets us attach the others read-only
+    conn.create_function('ignored_path', 1, deterministic=True,
+                         func=lambda path: any(should_ignore(path_element)  # not the first one as it's always '.'
+                                               for path_element in path.split(os.path.sep)[1:]))
+    algorithm_sql = {}
+    for i, (node_name, db_file) in enumerate(databases.items()):
+        conn.execute(f'ATTACH DATABASE ? AS node{i}', (read_only_uri(db_file, node_name),))
+        columns = {row[1] for row in conn.execute(f'PRAGMA node{i}.table_info(bitrot)')}
+        # older databases don't have an algorithm column, and NULL means SHA-1 anyway
+        algorithm_sql[i] = f"coalesce(node{i}.bitrot.algorithm, '{DEFAULT_ALGORITHM}')" \
+            if 'algorithm' in columns else f"'{DEFAULT_ALGORITHM}'"
+    nodes = list(databases)
+    try:
+        for i in range(len(nodes)):
+            for j in range(i + 1, len(nodes)):
+                query = (f'SELECT node{i}.bitrot.path, {algorithm_sql[i]}, node{i}.bitrot.hash, node{j}.bitrot.hash '
+                         f'FROM node{i}.bitrot JOIN node{j}.bitrot ON node{j}.bitrot.path = node{i}.bitrot.path '
+                         f'WHERE node{i}.bitrot.hash != node{j}.bitrot.hash '
+                         f'AND {algorithm_sql[i]} = {algorithm_sql[j]} '
+                         f'AND NOT ignored_path(node{i}.bitrot.path)')
+                for path, algorithm, h, other_hash in conn.execute(query):
+                    yield path, algorithm, nodes[i], h, nodes[j], other_hash
+    finally:
+        conn.close()
+
+
+def compare_nodes(report=False) -> list[str]:
+    """Look for any discrepancies between hashes recorded on different nodes.
+    If `report` is True, also save the clashes in the bitrot_clashes table of this node's database."""
+    databases = node_databases()
+    clashes = {}  # path: list of clash tuples, in the order they were found
+    for clash in find_clashes(databases):
+        path = clash[0]
+        if path not in clashes:
+            print(f'Bad hash for {path}')
+        clashes.setdefault(path, []).append(clash)
+    if report and node() in databases:
+        conn = get_sqlite3_cursor(databases[node()])
+        checked = ts()
+        conn.execute('DELETE FROM bitrot_clashes')
+        conn.executemany('INSERT INTO bitrot_clashes (path, algorithm, node, hash, other_node, other_hash, checked) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (clash + (checked,) for path_clashes in clashes.values() for clash in path_clashes))
+        conn.commit()
+    return list(clashes)
 
 
-def compare_nodes() -> list[str]:
-    """Look for any discrepancies between hashes recorded on different nodes."""
-    hashes = {}
-    clashes = []
-    for db_file in os.listdir():
-        if not (db_file.startswith('.bitrot-') and db_file.endswith('.db')):
-            continue
-        db = get_sqlite3_cursor(db_file)
-        hash_list = db.execute('SELECT path, hash FROM bitrot').fetchall()
-        db.commit()
-        print(db_file, len(hash_list), 'hashes')
-        for path, h in hash_list:
-            # Skip files that meet the ignore criteria
-            if any([should_ignore(path_element)
-                    for path_element in path.split(os.path.sep)[1:]]):  # not the first one as it's always '.'
-                continue
-            if path not in hashes:
-                hashes[path] = h
-            elif hashes[path] != h:
-                clashes.append(path)
-                print(f'Bad hash for {path}')
-    return clashes
+class Duplicate(NamedTuple):
+    """A file with the same contents as another, according to the database."""
+    path: str  # including the folder it's in
+    size: int | None
+    mtime: int
+    inode: int | None
+
+
+def find_duplicates(directories=('.',), min_size=1):
+    """Look for files with the same hash in the bitrot databases of the given `directories`, and yield
+    lists of Duplicates for each set of files with the same contents. Nothing gets read or hashed
+    again. Each list is in order of preference: files in earlier directories first, then shorter paths.
+    Files smaller than `min_size` are left out, so empty files don't count."""
+    conn = sqlite3.connect('file::memory:', uri=True)  # uri=True lets us attach the databases read-only
+    for i, directory in enumerate(directories):
+        conn.execute(f'ATTACH DATABASE ? AS folder{i}', (read_only_uri(get_path(directory)),))
+    try:
+        # the hash index makes this a scan of the index rather than the table when there's one folder
+        union = ' UNION ALL '.join(f"SELECT hash, coalesce(algorithm, '{DEFAULT_ALGORITHM}') AS algorithm "
+                                   f'FROM folder{i}.bitrot WHERE size IS NULL OR size >= {int(min_size)}'
+                                   for i in range(len(directories)))
+        query = f'SELECT hash, algorithm FROM ({union}) GROUP BY hash, algorithm HAVING COUNT(*) > 1'
+        for h, algorithm in conn.execute(query).fetchall():
+            group = []
+            for i, directory in enumerate(directories):
+                rows = conn.execute(f'SELECT path, size, mtime, inode FROM folder{i}.bitrot '
+                                    f"WHERE hash=? AND coalesce(algorithm, '{DEFAULT_ALGORITHM}')=? "
+                                    'ORDER BY length(path), path', (h, algorithm))
+                group += [Duplicate(os.path.normpath(os.path.join(directory, path)), *row) for path, *row in rows]
+            yield group
+    finally:
+        conn.close()
+
+
+def find_wasted_space(directories=('.',), action=None, verbosity=1, test=False):
+    """Report on duplicate files in the given `directories`, and the space they waste in each folder.
+    Copies that are already hard links to the same file (the same device and inode) don't waste anything.
+    Optionally do something with the extra copies: `action` can be 'hardlink' to replace them
+    with links to the first copy, or 'trash' to send them to the recycle bin.
+    If `test` is True, just say what would be done. Return the total wasted bytes."""
+    wasted = {}  # folder: bytes
+    for group in find_duplicates(directories):
+        keep = group[0]
+        # inode numbers are only unique on one device, and the folders might be on different ones
+        seen_files = {file_identity(keep.path)}
+        if verbosity > 1:
+            print(f'{human_format(keep.size or 0, binary=True, split_with=" ")}iB: {keep.path}')
+        for duplicate in group[1:]:
+            identity = file_identity(duplicate.path)
+            if identity is not None and identity in seen_files:
+                continue  # already a hard link
+            seen_files.add(identity)
+            if verbosity > 1:
+                print(f'  {duplicate.path}')
+            folder = os.path.dirname(duplicate.path)
+            wasted[folder] = wasted.get(folder, 0) + (duplicate.size or 0)
+            if action:
+                remove_duplicate(keep, duplicate, action, test)
+    total = sum(wasted.values())
+    if verbosity:
+        by_size = sorted(wasted.items(), key=lambda item: item[1], reverse=True)
+        for folder, size in by_size if verbosity > 1 else by_size[:20]:  # just the worst ones
+            print(f'{human_format(size, binary=True, split_with=" ")}iB\t{folder}')
+        print(f'{human_format(total, binary=True, split_with=" ")}iB wasted in {len(wasted)} folders.')
+    return total
+
+
+def file_identity(path):
+    """Return (st_dev, st_ino) for a file, which is the same for all the hard links to it,
+    or None if it isn't there."""
+    st = get_stat(path)
+    return None if st is None else (st.st_dev, st.st_ino)
+
+
+def remove_duplicate(keep, duplicate, action, test=False):
+    """Replace the file `duplicate` with a hard link to `keep` (if `action` is 'hardlink'),
+    or send it to the recycle bin (if `action` is 'trash'). Both are Duplicate tuples.
+    Nothing is done if either file has changed since it was hashed."""
+    try:
+        stats = [os.stat(keep.path), os.stat(duplicate.path)]
+    except FileNotFoundError as ex:
+        print(f'Skipping {duplicate.path}: {ex.filename} not found')
+        return
+    if os.path.samestat(*stats):
+        return  # linked since the database was updated
+    for file, st in zip((keep, duplicate), stats):
+        if not stat_unchanged(st, (file.mtime, file.size, file.inode)):
+            print(f'Skipping {duplicate.path}: {file.path} changed since it was last checked')
+            return
+    print(f'{"Would " if test else ""}{action} {duplicate.path}')
+    if test:
+        return
+    if action == 'trash':
+        send2trash(duplicate.path)
+    elif action == 'hardlink':
+        # make the link next to the duplicate and then swap it in, so there's no moment without a file there
+        temp_path = duplicate.path + '.bitrot-link'
+        try:
+            os.link(keep.path, temp_path)
+        except OSError as ex:  # e.g. different drives
+            print(f'Skipping {duplicate.path}: {ex.strerror}')
+            return
+        os.replace(temp_path, duplicate.path)
 
 
 def should_ignore(path_element: str) -> bool:
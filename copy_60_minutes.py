@@ -1,16 +1,18 @@
 import asyncio
+import json
 import os
 import random
 import re
+import sqlite3
 import tempfile
 import time
 from collections import Counter
-from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, suppress
 from datetime import datetime, timedelta
-from difflib import get_close_matches
-from functools import reduce
-from shutil import copy2  # to copy files
-from typing import NamedTuple
+from platform import node
+from shutil import copyfile, copystat  # to copy files
+from typing import Iterable, NamedTuple
 
 import phrydy  # to get media data
 import pushbullet
@@ -20,13 +22,23 @@ from progress.bar import Bar, IncrementalBar
 from send2trash import send2trash
 
 from folders import music_folder, radio_folder
-from lastfm import lastfm
 from media import is_media_file, artist_title
 from pushbullet_api_key import api_key  # local file, keep secret!
+from scrobbles import ScrobbleMatcher, recent_titles
 from tools import remove_bad_chars
 
 music_folder = os.path.realpath(music_folder)  # fix issues with symlinks
 copy_log_file = 'copied_already.txt'
+# one per computer, since the music folder isn't in the same place on each
+album_index_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'album-index-{node()}.db')
+index_trust_days = 30  # after this long, check the files in a folder even if it hasn't changed
+# Reading tags is mostly waiting for the network share, so it's worth having plenty of reads going at once
+tag_read_workers = 16
+tag_reader = ThreadPoolExecutor(max_workers=tag_read_workers, thread_name_prefix='read_tags')
+# Copying is limited by the network too, but too many at once just makes them all slow
+copy_workers = 4
+copier = ThreadPoolExecutor(max_workers=copy_workers, thread_name_prefix='copy_file')
+manifest_name = '.copy-manifest.json'  # left in a copied folder until all its files are there
 Album = dict[str, float]
 
 test_mode = False
@@ -80,77 +92,236 @@ class Tags(NamedTuple):
     """The album title."""
     length: float
     """The length of the album in minutes."""
+    track: int | None = None
+    """The track number."""
+    title: str | None = None
+    """The track title."""
+
+
+class FolderPicker(object):
+    """Media files grouped by folder, for choosing folders at random and crossing them off in constant time."""
+
+    def __init__(self, file_list: list[tuple[str, str]] = ()):
+        self.files: dict[str, list[str]] = {}
+        """Files in each folder."""
+        for folder, file in file_list:
+            self.files.setdefault(folder, []).append(file)
+        self.folders = list(self.files)
+        """Folders that haven't been crossed off yet, in no particular order."""
+        self._positions = {folder: i for i, folder in enumerate(self.folders)}
+
+    def __len__(self) -> int:
+        return len(self.folders)
+
+    def choose(self) -> tuple[str, str]:
+        """Return a random folder, and a random file from it."""
+        folder = random.choice(self.folders)
+        return folder, random.choice(self.files[folder])
+
+    def remove(self, folder: str) -> None:
+        """Cross off a folder so it won't be chosen again, by moving the last one into its place."""
+        position = self._positions.pop(folder)
+        last = self.folders.pop()
+        if last != folder:
+            self.folders[position] = last
+            self._positions[last] = position
+
+
+class AlbumIndex(object):
+    """Tags read on earlier runs, stored in an SQLite database so that we don't need to read them again.
+    Rows are kept for each file with its mtime and size, and are only used while those stay the same.
+    A folder's own mtime only changes when files are added, removed or renamed, so once all its files
+    are in the index, an unchanged folder can be used without looking at each file."""
+
+    def __init__(self, filename: str = album_index_file):
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tracks (folder TEXT, file TEXT, mtime REAL, size INTEGER, '
+                              'artist TEXT, album_artist TEXT, album_title TEXT, length REAL, track INTEGER, '
+                              'title TEXT, PRIMARY KEY (folder, file))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime REAL, checked REAL)')
+        self.read_count = 0
+        """The number of files whose tags came from the index rather than the files themselves."""
+
+    def close(self):
+        self.conn.close()
+
+    def cached_tags(self, folder: str, files: list[str]) -> dict[str, Tags]:
+        """Return a dict of Tags for the files in the folder that are in the index and haven't changed."""
+        rows = self.conn.execute('SELECT file, mtime, size, artist, album_artist, album_title, length, track, title '
+                                 'FROM tracks WHERE folder=?', (folder,)).fetchall()
+        stored = self.conn.execute('SELECT mtime, checked FROM folders WHERE folder=?', (folder,)).fetchone()
+        wanted = set(files)
+        if stored and stored[0] == os.stat(folder).st_mtime and stored[1] > time.time() - index_trust_days * 86400:
+            current = [row for row in rows if row[0] in wanted]
+        else:
+            with os.scandir(folder) as entries:
+                stats = {entry.name: entry.stat() for entry in entries if entry.name in wanted}
+            current = []
+            changed = []
+            for row in rows:
+                st = stats.get(row[0])
+                (current if st and (st.st_mtime, st.st_size) == row[1:3] else changed).append(row)
+            with self.conn:  # forget files that have changed or gone
+                self.conn.executemany('DELETE FROM tracks WHERE folder=? AND file=?',
+                                      [(folder, row[0]) for row in changed])
+        self.read_count += len(current)
+        # use album artist (if available) so we can compare 'Various Artist' albums
+        return {file: Tags(folder, file, str(album_artist or artist), str(album_title), length, track, title)
+                for file, _, _, artist, album_artist, album_title, length, track, title in current}
+
+    def add(self, folder: str, file: str, media: phrydy.MediaFile) -> None:
+        """Store the tags for a file that has just been read."""
+        st = os.stat(os.path.join(folder, file))
+        self.conn.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (folder, file, st.st_mtime, st.st_size, media.artist, media.albumartist, media.album,
+                           media.length / 60, media.track, media.title))
+
+    def folder_done(self, folder: str, complete: bool) -> None:
+        """Save the tags added for a folder. If every file in it is now in the index, remember the folder's mtime."""
+        with self.conn:
+            if complete:
+                self.conn.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)',
+                                  (folder, os.stat(folder).st_mtime, time.time()))
+            else:
+                self.conn.execute('DELETE FROM folders WHERE folder=?', (folder,))
 
 
-def copy_album(album: AlbumKey, files: Album, existing_folder: str = '') -> str:
-    """Copy a given album to the copy folder."""
+def album_filename(album: AlbumKey) -> str:
+    """Return the part of a copied folder's name that comes from a given album."""
     if album.title:
         no_artist = album.artist in (None, 'None', '', 'Various', 'Various Artists')
         album_filename = remove_bad_chars(album.title if no_artist else f'{album.artist} - {album.title}')
     else:
         album_filename = os.path.basename(album.folder)
-    album_filename = album_filename[:60].strip('. ')  # shorten path names (Windows limit: 260 chars) and remove dots
-    if existing_folder:  # copying into an existing folder
-        copied_name = f'{existing_folder}; {album_filename}'
-        if not test_mode:
-            os.rename(existing_folder, copied_name)
-            n = max(int(file[:2]) for file in os.listdir(copied_name))  # highest track number in filename
-        else:
-            n = 0
-    else:  # making a new folder
-        copied_name = datetime.strftime(datetime.now(), '%Y-%m-%d ') + album_filename
-        if not test_mode:
-            os.mkdir(copied_name)
-        n = 0
-    if not test_mode:
-        os.chdir(copied_name)
-        for j, f in enumerate(files.keys(), start=1):
-            media_info = phrydy.MediaFile(os.path.join(album.folder, f))
-            name, ext = os.path.splitext(f)
-            try:
-                copy_filename = remove_bad_chars(f'{int(media_info.track) + n:02d} {media_info.title}{ext}')
-            except (ValueError, TypeError):  # e.g. couldn't get track name or number
-                copy_filename = f'{j + 1 + n:02d} {f}'  # fall back to original name
-            copy2(os.path.join(album.folder, f), copy_filename)
-        os.chdir('..')
-        with open(os.path.join(music_folder, copy_log_file), 'a', encoding='utf-8') as log_handle:
-            # don't write the music root folder, and convert '\' to '/' for cross-platform compatibility
-            folder = album.folder[len(music_folder) + 1:].replace('\\', '/')
-            log_handle.write(f'{folder}\t{album.artist}\t{album.title}\n')
-    return copied_name
-
-
-def reducible_copy_album(existing_folder: str, album_spec: tuple[AlbumKey, Album]) -> str:
-    """Version of copy_album that can be passed to functools.reduce for multiple subsequent copy operations."""
-    album, files = album_spec
-    return copy_album(album, files, existing_folder)
-
-
-async def get_tags(folder: str, file: str, album: dict, copied_already: set[str],
-                   bar: Bar | None = None) -> Tags | None:
-    """For a media file specified by the folder and file, return a Tags named tuple."""
-    # If there are only one set of tags in the folder, i.e. not a 'misc' folder,
-    # and the length in the scanned files is already too long, cancel the rest of the scan
-    # Also cancel if we've found one in copied_already list
-    too_long = album['length'] < 0 and len(album['keys']) == 1
-    if too_long or (album['keys'] and all(
-            key.tab_join() in copied_already for key in album['keys'])):  # gotcha: all([]) == True
-        return None  # to cancel the rest of the get_tags calls for this folder
-    if not (media := await read_tags(file, folder)):
-        return None
+    return album_filename[:60].strip('. ')  # shorten path names (Windows limit: 260 chars) and remove dots
+
+
+def track_filenames(tracks: list[Tags], first_number: int = 0, taken: Iterable[str] = ()) -> list[tuple[str, str]]:
+    """Return (source path, copied filename) for each of an album's tracks. Copied files are named
+    with the track number and title, with first_number added on so albums copied into the same folder follow on.
+    Names that would clash (e.g. two discs with '01 Intro', or with the names in taken) get ' (2)' etc. added."""
+    names = []
+    used = {name.casefold() for name in taken}  # the copies might be on a file system that ignores case
+    for j, tags in enumerate(tracks, start=1):
+        name, ext = os.path.splitext(tags.file)
+        try:
+            copy_filename = remove_bad_chars(f'{int(tags.track) + first_number:02d} {tags.title}{ext}')
+        except (ValueError, TypeError):  # e.g. couldn't get track name or number
+            copy_filename = f'{j + first_number:02d} {tags.file}'  # fall back to original name
+        stem, ext = os.path.splitext(copy_filename)
+        n = 2
+        while copy_filename.casefold() in used:
+            copy_filename = f'{stem} ({n}){ext}'
+            n += 1
+        used.add(copy_filename.casefold())
+        names.append((os.path.join(tags.folder, tags.file), copy_filename))
+    return names
+
+
+def write_manifest(destination: str, albums: list[AlbumKey], files: list[tuple[str, str]]) -> None:
+    """Make the destination folder, and write a manifest of the albums and files to be copied into it."""
+    os.makedirs(destination, exist_ok=True)
+    with open(os.path.join(destination, manifest_name), 'w', encoding='utf-8') as manifest_handle:
+        json.dump({'albums': [album.tab_join() for album in albums], 'files': files}, manifest_handle, indent=1)
+
+
+def copy_file(source: str, destination: str) -> None:
+    """Copy a file and its timestamps (like copy2), by way of a .part file so that a file with the real name
+    is always complete. Uses os.copy_file_range where it's available, which lets a network share copy
+    on the server; otherwise copyfile, which uses sendfile where it can."""
+    part_file = destination + '.part'
+    copied = False
+    if hasattr(os, 'copy_file_range'):  # Linux only
+        with open(source, 'rb') as source_handle, open(part_file, 'wb') as part_handle:
+            with suppress(OSError):  # e.g. not supported between these file systems
+                while os.copy_file_range(source_handle.fileno(), part_handle.fileno(), 1 << 30):
+                    pass
+                copied = True
+    if not copied:
+        copyfile(source, part_file)
+    copystat(source, part_file)
+    os.replace(part_file, destination)
+
+
+async def finish_copy(destination: str) -> bool:
+    """Copy the files listed in the manifest in the destination folder, apart from any that are there already.
+    Then add the albums to the copy log and remove the manifest, and return True.
+    If some files couldn't be copied, keep the manifest so the next run can try again, and return False.
+    Files whose source has gone are taken out of the manifest, since trying again won't help."""
+    manifest_file = os.path.join(destination, manifest_name)
+    with open(manifest_file, encoding='utf-8') as manifest_handle:
+        manifest = json.load(manifest_handle)
+    loop = asyncio.get_running_loop()
+    to_copy = [(source, name) for source, name in manifest['files']
+               if not os.path.exists(os.path.join(destination, name))]
+    results = await asyncio.gather(*(loop.run_in_executor(copier, copy_file, source, os.path.join(destination, name))
+                                     for source, name in to_copy), return_exceptions=True)
+    failed = [(source, result) for (source, _), result in zip(to_copy, results) if isinstance(result, Exception)]
+    for source, error in failed:
+        print(f'Failed to copy {source}: {error}')
+    gone = {source for source, _ in failed if not os.path.exists(source)}
+    if len(gone) < len(failed):  # try again next time
+        manifest['files'] = [file for file in manifest['files'] if file[0] not in gone]
+        with open(manifest_file, 'w', encoding='utf-8') as manifest_handle:
+            json.dump(manifest, manifest_handle, indent=1)
+        return False
+    with open(os.path.join(music_folder, copy_log_file), 'a', encoding='utf-8') as log_handle:
+        log_handle.write(''.join(f'{line}\n' for line in manifest['albums']))
+    os.remove(manifest_file)
+    return True
+
+
+async def resume_copies(copy_folder_list: list[Folder]) -> str:
+    """Finish off any copies that were interrupted, using the manifests left in their folders."""
+    toast = ''
+    for copy_folder in copy_folder_list:
+        for subfolder in get_subfolders(copy_folder.address):
+            destination = os.path.join(copy_folder.address, subfolder)
+            if os.path.exists(os.path.join(destination, manifest_name)):
+                print('Resuming copy into', destination)
+                if test_mode or await finish_copy(destination):
+                    toast += f'✔ {subfolder[11:]} (resumed)\n'
+                else:
+                    toast += f'⚠ {subfolder[11:]} (not all copied, will try again)\n'
+    return toast
+
+
+async def get_tags(folder: str, file: str, album: dict, copied_already: set[str], read_slots: asyncio.Semaphore,
+                   bar: Bar | None = None, album_index: AlbumIndex | None = None) -> Tags | None:
+    """For a media file specified by the folder and file, return a Tags named tuple.
+    Only as many files as read_slots allows are read at once. The tags are stored in the album_index if one is given."""
+    async with read_slots:
+        # Now it's our turn, check whether the rest of the folder is still worth reading.
+        # If there are only one set of tags in the folder, i.e. not a 'misc' folder,
+        # and the length in the scanned files is already too long, cancel the rest of the scan
+        # Also cancel if we've found one in copied_already list
+        too_long = album['length'] < 0 and len(album['keys']) == 1
+        if too_long or (album['keys'] and all(
+                key.tab_join() in copied_already for key in album['keys'])):  # gotcha: all([]) == True
+            return None  # to cancel the rest of the get_tags calls for this folder
+        if not (media := await read_tags(file, folder)):
+            return None
     if bar:
         bar.next()
+    if album_index:
+        album_index.add(folder, file, media)
     length = media.length / 60
     album['length'] -= length  # count down from initial value of maximum wanted
     # use album artist (if available) so we can compare 'Various Artist' albums
     album_artist = str(media.albumartist or media.artist)
     album_title = str(media.album)
     album['keys'].add(AlbumKey(folder, album_artist, album_title))
-    return Tags(folder, file, album_artist, album_title, length)
+    return Tags(folder, file, album_artist, album_title, length, media.track, media.title)
 
 
 async def read_tags(file: str, folder: str) -> phrydy.MediaFile | None:
-    """Read tags from a media file."""
+    """Read tags from a media file, in the tag_reader thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(tag_reader, load_tags, file, folder)
+
+
+def load_tags(file: str, folder: str) -> phrydy.MediaFile | None:
+    """Read tags from a media file (blocking)."""
     filename = os.path.join(folder, file)
     try:
         media = phrydy.MediaFile(filename)
@@ -184,150 +355,220 @@ def get_album_files() -> list[tuple[str, str]]:
             for file in filter(is_media_file, file_list)]
 
 
+def plan_albums(to_fill: dict[Folder, int], lengths: dict[AlbumKey, float],
+                tries: int = 100) -> list[tuple[Folder, list[AlbumKey]]]:
+    """Share out albums between the folders in to_fill, each of which needs the given number of new subfolders,
+    so that each subfolder's total length is in its folder's range. Each try is a first-fit decreasing packing
+    with the subfolders and the album lengths shuffled a little, and the try that fills the most subfolders wins.
+    Return a list of (folder, album keys) for each subfolder that would be filled."""
+    wanted = sum(to_fill.values())
+    best = []
+    for _ in range(tries):
+        subfolders = [(folder, []) for folder, count in to_fill.items() for _ in range(count)]
+        random.shuffle(subfolders)
+        totals = [0.0] * len(subfolders)
+        # longest first, but not always in the same order
+        for key in sorted(lengths, key=lambda k: lengths[k] * random.uniform(0.8, 1.2), reverse=True):
+            length = lengths[key]
+            fits = [i for i, (folder, _) in enumerate(subfolders)
+                    if totals[i] < folder.min_length and totals[i] + length <= folder.max_length]
+            # go for one that this would fill, otherwise the first with room for it
+            i = next((i for i in fits if totals[i] + length >= subfolders[i][0].min_length), fits[0] if fits else None)
+            if i is not None:
+                subfolders[i][1].append(key)
+                totals[i] += length
+        filled = [(folder, keys) for (folder, keys), total in zip(subfolders, totals) if total >= folder.min_length]
+        if len(filled) > len(best):
+            best = filled
+            if len(best) == wanted:
+                break
+    return best
+
+
+def extend_plan(to_fill: dict[Folder, int], plan: list[tuple[Folder, list[AlbumKey]]],
+                candidates: dict[AlbumKey, float], new_key: AlbumKey) -> bool:
+    """Try to fill one more subfolder, starting with the album new_key and making up the length with candidates
+    the plan isn't using yet, longest first. If that works, add (folder, album keys) to the plan and return True.
+    Much quicker than running plan_albums again every time another album turns up."""
+    planned_keys = {key for _, keys in plan for key in keys}
+    if new_key in planned_keys:
+        return False
+    spare = sorted((key for key in candidates if key not in planned_keys and key != new_key),
+                   key=candidates.get, reverse=True)
+    for folder, count in to_fill.items():
+        if sum(1 for planned_folder, _ in plan if planned_folder == folder) >= count:
+            continue  # all of this folder's subfolders are filled already
+        keys, total = [new_key], candidates[new_key]
+        for key in spare:
+            if total >= folder.min_length:
+                break
+            if total + candidates[key] <= folder.max_length:
+                keys.append(key)
+                total += candidates[key]
+        if folder.min_length <= total <= folder.max_length:
+            plan.append((folder, keys))
+            return True
+    return False
+
+
 async def copy_albums(copy_folder_list: list[Folder],
                       supplied_file_list: list[tuple[str, str]],
-                      copied_already: set[str]) -> tuple[str, str]:
+                      copied_already: set[str],
+                      album_index: AlbumIndex) -> tuple[str, str]:
     """Select random albums up to the given length for each folder.
-    Avoids a big scan of tags by picking folders and files at random from a (fast) os.walk list."""
+    Avoids a big scan of tags by picking folders and files at random from a (fast) os.walk list,
+    and using tags stored in the album_index where they're still current.
+    Albums found are shared out between all the folders by extend_plan as they come in (and by plan_albums
+    if we run out of albums), and nothing is copied until there's a plan that fills all of them."""
     toast = ''
     scanned_albums: dict[AlbumKey, Album] = {}
     """Albums are defined by distinct values of (folder, artist, album_name).
     Each value in the album dict is a dict with filenames as keys and duration in minutes as values."""
+    scanned_tags: dict[tuple[str, str], Tags] = {}
+    """Tags for each scanned (folder, file), kept for naming the copies."""
+    candidates: dict[AlbumKey, float] = {}
+    """Albums that could be copied, with their lengths in minutes."""
+    to_fill: dict[Folder, int] = {}
+    """The number of subfolders needed in each copy folder."""
+    for copy_folder in copy_folder_list:
+        to_fill[copy_folder] = 1 if test_mode else copy_folder.min_count - len(get_subfolders(copy_folder.address))
+    wanted = sum(to_fill.values())
+    folder_picker = FolderPicker(supplied_file_list)
     os.chdir(music_folder)
     base_folder = os.getcwd()  # in case of symlinks: base_folder != music_folder
     start_time = datetime.now()
     max_length_overall = max(copy_folder.max_length for copy_folder in copy_folder_list)
     image_filenames = []
-    for copy_folder in copy_folder_list:
-        file_list = supplied_file_list.copy()  # reset file list since we remove from it for each copy_folder
-        print('\n', copy_folder, sep='')
-        min_length, max_length = copy_folder.min_length, copy_folder.max_length
-        maybe_list: list[dict[AlbumKey, Album]] = []
-        os.chdir(copy_folder.address)
-        to_copy = 1 if test_mode else copy_folder.min_count - len(get_subfolders())
-        while to_copy > 0 and len(file_list) > 0:
-            start_loop = datetime.now()
-
-            # pick a random folder and a random track from it
-            chosen_folder = random.choice(list(set(folder for folder, _ in file_list)))
-            chosen_file = random.choice([file for folder, file in file_list if folder == chosen_folder])
-            # alternative naive method, favours big folders
-            # chosen_folder, chosen_file = random.choice(file_list)
-
-            # scanned this folder yet?
-            chosen_key = next((key for key, album in scanned_albums.items()
-                               if key[0] == chosen_folder and chosen_file in album),
-                              None)
-            if chosen_key is None:  # not scanned this folder yet
-                # find other tracks in album - how long is it?
-                folder_files = [file for folder, file in file_list if folder == chosen_folder]
-                # scan chosen file first (avoids problems if cancelling scan early)
-                folder_files.remove(chosen_file)
-                folder_files.insert(0, chosen_file)
-                # display progress if it's going to take a while
-                bar = IncrementalBar(chosen_folder[len(base_folder) + 1:],
-                                     max=len(folder_files),
-                                     suffix='%(index)d/%(max)d ') if len(folder_files) > 20 else None
-                async with asyncio.TaskGroup() as task_group:
-                    album = {'length': max_length_overall, 'keys': set()}  # to track total length across get_tags calls
-                    get_tags_tasks = [task_group.create_task(get_tags(chosen_folder, file, album, copied_already, bar))
-                                      for file in folder_files]
-                if bar:  # erase progress bar
-                    print('\r' + ' ' * bar._max_width, end='\r')
-                folder_tags = filter(None, [task.result() for task in get_tags_tasks])
-                # add everything in folder to albums list for later reference
-                for tags in folder_tags:
-                    # albums is a dict of dicts: each subdict stores (file, duration) as (key, value) pairs
-                    key = AlbumKey(tags.folder, tags.artist, tags.album_title)
-                    scanned_albums.setdefault(key, {})[tags.file] = tags.length
-                    if tags.file == chosen_file:
-                        chosen_key = key
-
-            print(chosen_key, end=' ')
-            # remove all tracks from list so we won't choose it again
-            # note this is potentially removing more than just in chosen_key
-            # edge case: 'misc' folders with several albums might get missed
-            # if first chosen track has been copied already
-            file_list = [(folder, file) for folder, file in file_list if folder != chosen_folder]
-            elapsed = (datetime.now() - start_loop).total_seconds() * 1000
-
-            if chosen_key.tab_join() in copied_already:
+    read_slots = asyncio.Semaphore(tag_read_workers)  # get_tags waits for one of these before reading a file
+    plan = []
+    while len(plan) < wanted and len(folder_picker) > 0:
+        start_loop = datetime.now()
+
+        # pick a random folder and a random track from it
+        chosen_folder, chosen_file = folder_picker.choose()
+        # alternative naive method, favours big folders
+        # chosen_folder, chosen_file = random.choice(file_list)
+
+        # find other tracks in album - how long is it?
+        folder_files = folder_picker.files[chosen_folder].copy()
+        # scan chosen file first (avoids problems if cancelling scan early)
+        folder_files.remove(chosen_file)
+        folder_files.insert(0, chosen_file)
+        # only read the ones that aren't in the index already
+        cached = album_index.cached_tags(chosen_folder, folder_files)
+        files_to_read = [file for file in folder_files if file not in cached]
+        # display progress if it's going to take a while
+        bar = IncrementalBar(chosen_folder[len(base_folder) + 1:],
+                             max=len(files_to_read),
+                             suffix='%(index)d/%(max)d ') if len(files_to_read) > 20 else None
+        album = {'length': max_length_overall, 'keys': set()}  # to track total length across get_tags calls
+        for tags in cached.values():
+            album['length'] -= tags.length
+            album['keys'].add(AlbumKey(tags.folder, tags.artist, tags.album_title))
+        async with asyncio.TaskGroup() as task_group:
+            get_tags_tasks = [task_group.create_task(get_tags(chosen_folder, file, album, copied_already,
+                                                              read_slots, bar, album_index))
+                              for file in files_to_read]
+        if bar:  # erase progress bar
+            print('\r' + ' ' * bar._max_width, end='\r')
+        read_tags_list = [task.result() for task in get_tags_tasks]
+        album_index.folder_done(chosen_folder, complete=all(read_tags_list))
+        folder_tags = list(cached.values()) + list(filter(None, read_tags_list))
+        # add everything in folder to albums list for later reference
+        folder_keys = []  # in the order found, so the chosen file's album comes first
+        for tags in folder_tags:
+            # albums is a dict of dicts: each subdict stores (file, duration) as (key, value) pairs
+            key = AlbumKey(tags.folder, tags.artist, tags.album_title)
+            scanned_albums.setdefault(key, {})[tags.file] = tags.length
+            scanned_tags[tags.folder, tags.file] = tags
+            if key not in folder_keys:
+                folder_keys.append(key)
+        # remove folder from list so we won't choose it again
+        folder_picker.remove(chosen_folder)
+        elapsed = (datetime.now() - start_loop).total_seconds() * 1000
+
+        # 'misc' folders can have several albums in them: any of them might be useful
+        new_keys = []
+        for key in folder_keys:
+            print(key, end=' ')
+            if key.tab_join() in copied_already:
                 print(f'❌  copied already {elapsed:.0f}ms')
                 continue
 
-            if len(scanned_albums[chosen_key]) < 2:
+            if len(scanned_albums[key]) < 2:
                 print(f'❌  not enough tracks {elapsed:.0f}ms')
                 continue
 
-            length = sum(scanned_albums[chosen_key].values())
+            length = sum(scanned_albums[key].values())
             print(f'({round(length)} min)', end=' ')
-            if length > max_length:
+            if length > max_length_overall:
                 print(f'❌  too long {elapsed:.0f}ms')
                 continue
 
-            # could we add this to any existing lists?
-            new_lengths = [sum(sum(album.values()) for album in copy_dict.values()) + length
-                           for copy_dict in maybe_list]
-            if any(in_range := [l if min_length <= l <= max_length else False for l in new_lengths]):
-                # go for the longest available
-                print('in range:', list_lengths(in_range), end=' ')
-                index = in_range.index(max(in_range))
-            elif any(below_max := [l if l <= max_length else False for l in new_lengths]):
-                # need to fit more in, so go for the shortest - more likely to get something
-                print('below max:', list_lengths(below_max), end=' ')
-                index = below_max.index(min(below_max))
-            else:
-                index = None
-            if index is not None:
-                copy_dict = maybe_list[index]
-                new_length = new_lengths[index]
-                print('✔️ appended to', *copy_dict.keys())
-                copy_dict[chosen_key] = scanned_albums[chosen_key]
-            else:  # new list
-                maybe_list.append({chosen_key: scanned_albums[chosen_key]})
-                new_length = length
-                print('✔️')
-            if new_length >= min_length:
-                to_copy -= 1
-                print(f'✔️ Got enough, {to_copy=}')
-
-        if to_copy:  # ran out of albums
+            candidates[key] = length
+            new_keys.append(key)
+            print(f'✔️ {elapsed:.0f}ms')
+
+        if any([extend_plan(to_fill, plan, candidates, key) for key in new_keys]):  # try all of them
+            print(f'✔️ Got enough for {len(plan)}/{wanted}')
+
+    if len(plan) < wanted and candidates:
+        # ran out of albums: a fresh look at all of them together might fill more subfolders
+        if len(new_plan := plan_albums(to_fill, candidates)) > len(plan):
+            plan = new_plan
+            print(f'✔️ Got enough for {len(plan)}/{wanted}')
+
+    destinations = []
+    for copy_folder, count in to_fill.items():
+        planned = [keys for folder, keys in plan if folder == copy_folder]
+        if len(planned) < count:  # ran out of albums
             toast += f'⏹ Not enough found with length {copy_folder.min_length}-{copy_folder.max_length} minutes\n'
-            continue
 
-        # copy from copy_list
-        for copy_dict in maybe_list:
-            lengths = (sum(album.values()) for album in copy_dict.values())
-            total_length = sum(lengths)
-            if min_length <= total_length <= max_length:
-                copied_already |= {key.tab_join() for key in copy_dict.keys()}
-                folder_name = reduce(reducible_copy_album, copy_dict.items(), '')
-                folder_name_inc_length = f'{folder_name} [{total_length:.0f}]'
-                if not test_mode:
-                    with suppress(OSError):  # doesn't matter if an error occurs here
-                        os.rename(folder_name, folder_name_inc_length)
-                toast += f'✔ {folder_name_inc_length[11:]}\n'
-                for key, album in sorted(copy_dict.items(), reverse=True,
-                                         key=lambda item: sum(item[1].values())):
-                    # Check for embedded images in the tags of the first file
-                    media = await read_tags(list(album.keys())[0], key.folder)
-                    if media.art:
-                        _, image_filename = tempfile.mkstemp()
-                        open(image_filename, 'wb').write(media.art)
-                    else:
-                        # Otherwise, look in the folder
-                        image_filename = next((os.path.join(key.folder, file) for file in os.listdir(key.folder)
-                                              if file.lower().endswith(('.png', '.jpg', '.jpeg'))
-                                               and not file.lower().startswith(('cd.', 'back.'))), '')
-                    if image_filename:
-                        image_filenames.append(image_filename)
-                        continue
+        # copy from plan
+        for keys in planned:
+            copy_dict = {key: scanned_albums[key] for key in keys}
+            total_length = sum(candidates[key] for key in keys)
+            copied_already |= {key.tab_join() for key in copy_dict.keys()}
+            folder_name = (datetime.strftime(datetime.now(), '%Y-%m-%d ') + '; '.join(map(album_filename, keys)) +
+                           f' [{total_length:.0f}]')
+            files = []
+            for key, album in copy_dict.items():
+                # number the tracks of each album on from the one before
+                first_number = max((int(name[:2]) for _, name in files), default=0)
+                files += track_filenames([scanned_tags[key.folder, file] for file in sorted(album)], first_number,
+                                         taken=[name for _, name in files])
+            if not test_mode:
+                destination = os.path.join(copy_folder.address, folder_name)
+                write_manifest(destination, keys, files)
+                destinations.append(destination)
+            toast += f'✔ {folder_name[11:]}\n'
+            for key, album in sorted(copy_dict.items(), reverse=True,
+                                     key=lambda item: sum(item[1].values())):
+                # Check for embedded images in the tags of the first file
+                media = await read_tags(list(album.keys())[0], key.folder)
+                if media.art:
+                    _, image_filename = tempfile.mkstemp()
+                    open(image_filename, 'wb').write(media.art)
+                else:
+                    # Otherwise, look in the folder
+                    image_filename = next((os.path.join(key.folder, file) for file in os.listdir(key.folder)
+                                          if file.lower().endswith(('.png', '.jpg', '.jpeg'))
+                                           and not file.lower().startswith(('cd.', 'back.'))), '')
+                if image_filename:
+                    image_filenames.append(image_filename)
+                    continue
+
+    # every manifest is written before any copying starts, so if this gets interrupted it can be finished next time
+    for destination in destinations:
+        if not await finish_copy(destination):
+            toast += f'⚠ {os.path.basename(destination)[11:]} (not all copied, will try again)\n'
 
     files_scanned = sum(len(album) for album in scanned_albums.values())
+    files_read = files_scanned - album_index.read_count
     elapsed_seconds = (datetime.now() - start_time).total_seconds()
     scan_percentage = 100 * files_scanned / len(supplied_file_list)
-    print(f'\nRead {files_scanned} files ({scan_percentage:.1f}% of total)'
-          f' in {elapsed_seconds :.1f}s, {files_scanned / elapsed_seconds :.0f} files/sec')
+    print(f'\nScanned {files_scanned} files ({scan_percentage:.1f}% of total, {album_index.read_count} from the index)'
+          f' in {elapsed_seconds :.1f}s, read {files_read / elapsed_seconds :.0f} files/sec')
 
     if not image_filenames:
         return toast, ''
@@ -354,11 +595,6 @@ async def copy_albums(copy_folder_list: list[Folder],
     return toast, output_image
 
 
-def list_lengths(lengths: list[float]) -> str:
-    """Return a comma-separated string of lengths with 1 decimal place."""
-    return ', '.join([f'{l:.1f}' for l in filter(None, lengths)])
-
-
 def read_copy_log(max_size: int = 700) -> set[str]:
     """Read the copied_already.txt log file and output a set of lines in the file.
     Each line consists of a relative file path, album artist and title, separated by tabs.
@@ -384,7 +620,8 @@ def read_copy_log(max_size: int = 700) -> set[str]:
 
 async def check_folder_list(copy_folder_list: list[Folder]) -> tuple[str, list[Folder]]:
     """Go through each copy folder in turn. Delete subfolders from it if they've been played."""
-    scrobbles = get_scrobbles()
+    # sometimes Last.fm artists/titles aren't quite the same as mine - the matcher looks for close matches
+    scrobbles = ScrobbleMatcher(get_scrobbles())
     toast = ''
     folders_to_fill = []
     for copy_folder in copy_folder_list:
@@ -402,8 +639,7 @@ async def check_folder_list(copy_folder_list: list[Folder]) -> tuple[str, list[F
             artist_titles = [t.result() for t in tasks]
             played_count = 0
             for tags in artist_titles:
-                # sometimes Last.fm artists/titles aren't quite the same as mine - look for close matches
-                if get_close_matches(tags, scrobbles, n=1, cutoff=0.9):
+                if tags in scrobbles:
                     played_count += 1
                     if played_count >= file_count / 2:
                         print(f'▶️  played at least {played_count}/{file_count} tracks')
@@ -424,13 +660,13 @@ async def check_folder_list(copy_folder_list: list[Folder]) -> tuple[str, list[F
 
 def get_scrobbles() -> list[str]:
     """Get recently played tracks (as reported by Last.fm)."""
-    played_tracks = lastfm.get_user('ning').get_recent_tracks(limit=200)
-    return [f'{track.track.artist.name} - {track.track.title}'.lower() for track in played_tracks]
+    return recent_titles('ning', limit=1000)
 
 
-def get_subfolders() -> list[str]:
+def get_subfolders(folder: str = '.') -> list[str]:
     """Return the subfolders in a folder that have a date prefix."""
-    return [folder for folder in os.listdir() if folder.startswith('20') and os.path.isdir(folder)]
+    return [subfolder for subfolder in os.listdir(folder)
+            if subfolder.startswith('20') and os.path.isdir(os.path.join(folder, subfolder))]
 
 
 def find_copy_folders() -> list[Folder]:
@@ -469,14 +705,18 @@ async def copy_60_minutes_async() -> str | tuple[str, str] | datetime:
         print('No folders to copy into on this device')
         return tomorrow_morning
     print(*copy_folder_list, sep='\n')
-    toast, copy_folder_list = await check_folder_list(copy_folder_list)
+    toast = await resume_copies(copy_folder_list)
+    check_toast, copy_folder_list = await check_folder_list(copy_folder_list)
+    toast += check_toast
     if not copy_folder_list:
         print('Not ready to copy new album.')
         return tomorrow_morning
 
     os.chdir(music_folder)
     copied_already = read_copy_log()
-    copy_toast, image_filename = await copy_albums(copy_folder_list, get_album_files(), copied_already)
+    with closing(AlbumIndex()) as album_index:
+        copy_toast, image_filename = await copy_albums(copy_folder_list, get_album_files(), copied_already,
+                                                       album_index)
     toast += copy_toast
     # if test_mode:
     #     profiler.stop()
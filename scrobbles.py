@@ -0,0 +1,137 @@
+import os
+import re
+import sqlite3
+import unicodedata
+from collections import Counter
+from contextlib import closing
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from platform import node
+from typing import Iterable
+
+import pylast
+
+from lastfm import lastfm  # contains secrets, so don't show them here
+
+# one per computer, in case the scripts folder is synced between them
+scrobble_store_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'scrobbles-{node()}.db')
+# Scrobbles made offline turn up later with the time they were played, so look back a bit further each time
+sync_overlap = timedelta(days=3)
+first_sync_limit = 999  # when the store is empty, don't fetch the whole history
+
+
+# Functions for working with tracks played, as scrobbled to Last.fm
+
+
+def normalise(text: str) -> str:
+    """Return a string with case, accents, punctuation and repeated spaces taken out, for comparing titles."""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+
+
+def trigrams(text: str) -> set[str]:
+    """Return the set of three-character pieces of a string (padded so short strings have some too)."""
+    text = f'  {text} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ScrobbleMatcher(object):
+    """Look up 'artist - title' strings among a list of scrobbles, allowing for small differences
+    (like difflib.get_close_matches with n=1), but without comparing against every scrobble each time.
+
+    Strings that are the same once normalised always match. Otherwise, only scrobbles that share at least
+    half of the string's trigrams are compared, and one matches if its SequenceMatcher ratio reaches cutoff.
+    Use cutoff=1 to only allow the normalised exact matches."""
+
+    def __init__(self, scrobbles: Iterable[str], cutoff: float = 0.9):
+        self.scrobbles = list(dict.fromkeys(scrobbles))  # without repeats, in order
+        self.cutoff = cutoff
+        self.exact = {normalise(scrobble): scrobble for scrobble in reversed(self.scrobbles)}  # first one wins
+        self.index: dict[str, list[int]] = {}
+        """Positions in the scrobble list of the scrobbles containing each trigram."""
+        if cutoff < 1:
+            for i, scrobble in enumerate(self.scrobbles):
+                for trigram in trigrams(scrobble):
+                    self.index.setdefault(trigram, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.scrobbles)
+
+    def __contains__(self, text: str) -> bool:
+        return self.match(text) is not None
+
+    def match(self, text: str) -> str | None:
+        """Return the scrobble that matches the given string, or None if there isn't one."""
+        if (scrobble := self.exact.get(normalise(text))) is not None:
+            return scrobble
+        if self.cutoff >= 1:
+            return None
+        text_trigrams = trigrams(text)
+        shared = Counter(i for trigram in text_trigrams for i in self.index.get(trigram, ()))
+        matcher = SequenceMatcher()
+        matcher.set_seq2(text)  # the one that SequenceMatcher caches information about
+        for i, count in shared.most_common():
+            if count < len(text_trigrams) / 2:
+                break  # the rest have even fewer in common
+            matcher.set_seq1(self.scrobbles[i])
+            if matcher.real_quick_ratio() >= self.cutoff and matcher.quick_ratio() >= self.cutoff \
+                    and matcher.ratio() >= self.cutoff:
+                return self.scrobbles[i]
+        return None
+
+
+class ScrobbleStore(object):
+    """A local copy of a Last.fm user's scrobbles, kept in an SQLite database and brought up to date by sync."""
+
+    def __init__(self, user_name: str = 'ning', filename: str = scrobble_store_file):
+        self.user_name = user_name
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS scrobbles (user TEXT, timestamp INTEGER, artist TEXT, '
+                              'title TEXT, album TEXT, PRIMARY KEY (user, timestamp, artist, title))')
+
+    def close(self):
+        self.conn.close()
+
+    def newest(self) -> int | None:
+        """Return the Unix time of the newest scrobble stored, or None if there aren't any."""
+        return self.conn.execute('SELECT MAX(timestamp) FROM scrobbles WHERE user=?', (self.user_name,)).fetchone()[0]
+
+    def sync(self) -> int:
+        """Fetch the scrobbles made since the newest one stored (less sync_overlap), and return how many were new.
+        If Last.fm can't be reached, carry on with what's stored."""
+        newest = self.newest()
+        user = lastfm.get_user(self.user_name)
+        try:
+            if newest is None:
+                played_tracks = user.get_recent_tracks(limit=first_sync_limit)
+            else:  # all of them, however many pages that takes
+                played_tracks = user.get_recent_tracks(limit=None,
+                                                       time_from=newest - int(sync_overlap.total_seconds()))
+        except pylast.PyLastError as e:
+            print("Couldn't fetch scrobbles:", e)
+            return 0
+        with self.conn:
+            changes_before = self.conn.total_changes
+            self.conn.executemany('INSERT OR IGNORE INTO scrobbles VALUES (?, ?, ?, ?, ?)',
+                                  [(self.user_name, int(played.timestamp), played.track.artist.name,
+                                    played.track.title, played.album) for played in played_tracks])
+        return self.conn.total_changes - changes_before
+
+    def titles(self, since: datetime | None = None, limit: int | None = None) -> list[str]:
+        """Return 'artist - title' in lower case for scrobbles since the given time (default: all of them),
+        newest first, up to the given number (default: no limit)."""
+        since_timestamp = int(since.timestamp()) if since else 0
+        rows = self.conn.execute('SELECT artist, title FROM scrobbles WHERE user=? AND timestamp>=? '
+                                 'ORDER BY timestamp DESC LIMIT ?', (self.user_name, since_timestamp, limit or -1))
+        return [f'{artist} - {title}'.lower() for artist, title in rows]
+
+
+def recent_titles(user_name: str = 'ning', since: datetime | None = None, limit: int | None = None) -> list[str]:
+    """Bring the scrobble store up to date, and return 'artist - title' in lower case for recent scrobbles,
+    newest first. See ScrobbleStore.titles."""
+    with closing(ScrobbleStore(user_name)) as store:
+        new_count = store.sync()
+        print(f'{new_count} new scrobbles')
+        return store.titles(since, limit)
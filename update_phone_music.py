@@ -12,8 +12,8 @@ from send2trash import send2trash
 
 import folders
 import media
-from lastfm import lastfm  # contains secrets, so don't show them here
 from pushbullet_api_key import api_key  # local file, keep secret!
+from scrobbles import ScrobbleMatcher, recent_titles
 
 test_mode = False  # don't change anything!
 
@@ -33,7 +33,7 @@ async def check_radio_files() -> str | tuple[str, str]:
     scrobbled_radio = []  # list of played radio files to delete
     first_unheard = ''  # first file in the list that hasn't been played
     extra_played_count = 0  # more files that have been played, after one that apparently hasn't
-    scrobbled_titles = get_scrobbled_titles(lastfm.get_user('ning'))
+    scrobbled_titles = get_scrobbled_titles('ning')
     os.chdir(folders.radio_folder)
     radio_files = os.listdir()
     total_file_count = len(radio_files)
@@ -142,10 +142,11 @@ def delete_file(file: str) -> str:
     return f'🗑️ {os.path.splitext(file)[0]}\n'
 
 
-def get_scrobbled_titles(lastfm_user, limit=999) -> list[str]:
-    # get recently played tracks (as reported by Last.fm)
-    return [f'{track.track.artist.name} - {track.track.title}'.lower() for track in
-            (lastfm_user.get_recent_tracks(limit=limit))]  # limit <= 999
+def get_scrobbled_titles(user_name: str, days: int = 180) -> ScrobbleMatcher:
+    # get recently played tracks (as reported by Last.fm, and stored locally)
+    # Only exact matches (ignoring case and punctuation): episode titles can differ by a single character,
+    # and a near miss here means deleting a file that hasn't been played
+    return ScrobbleMatcher(recent_titles(user_name, since=datetime.now() - timedelta(days=days)), cutoff=1)
 
 
 def get_data_from_music_update(push):